@@ -4,17 +4,14 @@ Created on Aug 23, 2016
 @author: Zongyang Li
 '''
 
-import os, json, sys, math, argparse, utm, shutil
-import matplotlib.pyplot as plt
-from matplotlib import cm
-from glob import glob
+# GDAL, utm, PIL and multiprocessing are imported inside the functions that use them
+# so that importing this module (e.g. from the flir2tif extractor) stays cheap.
+import os, json, sys, math, argparse, shutil
 import numpy as np
-from PIL import Image
 from math import cos, pi
-from osgeo import gdal, osr
-from numpy.matlib import repmat
 from datetime import date
-import multiprocessing
+
+from flir_reader import open_flir_bin, find_capture_dirs, scan_capture_dir
 
 ZERO_ZERO = (33.0745,-111.97475)
 
@@ -28,7 +25,14 @@ ay = 3659974.971; by = 1.0002; cy = 0.0078;
 ax = 409012.2032; bx = 0.009; cx = - 0.9986;
 lon_shift = 0.000020308287
 lat_shift = 0.000015258894
-SE_utm = utm.from_latlon(SE_latlon[0], SE_latlon[1])
+SE_utm = None
+
+def get_SE_utm():
+    global SE_utm
+    if SE_utm is None:
+        import utm
+        SE_utm = utm.from_latlon(SE_latlon[0], SE_latlon[1])
+    return SE_utm
 
 TILE_FOLDER_NAME = 'tif_list'
 
@@ -48,12 +52,17 @@ class calibParam:
 
 
 def options():
+    import multiprocessing
     
     parser = argparse.ArgumentParser(description='Convert FLIR raw data into pngs and temperature in geotiff',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     
     parser.add_argument("-i", "--in_dir", help="input directory, that contains of one day's flir data", required = True)
     parser.add_argument("-o", "--out_dir", help="output directory", required = True)
+    parser.add_argument("-w", "--workers", help="number of worker processes converting capture directories",
+                        type = int, default = multiprocessing.cpu_count())
+    parser.add_argument("-c", "--chunksize", help="capture directories handed to a worker at a time",
+                        type = int, default = 4)
     
     
     args = parser.parse_args()
@@ -69,6 +78,7 @@ def options():
     return args
 
 def main():
+    import multiprocessing
     
     args = options()
     
@@ -79,7 +89,7 @@ def main():
     os.makedirs(args.out_dir)
     
     print "Starting binary to image conversion..."
-    full_day_convert(args.in_dir, args.out_dir)
+    failures = full_day_convert(args.in_dir, args.out_dir, args.workers, args.chunksize)
     print "Completed binary to image conversion..."
     
     createVrt(args.out_dir, os.path.join(args.out_dir, 'tif_list.txt'))
@@ -91,9 +101,22 @@ def main():
     
     generate_googlemaps(args.out_dir)
     
+    # the tiles cover the captures that converted; still exit non-zero if any did not
+    if failures:
+        fail('Conversion failed for %s capture directories:' % len(failures))
+        for input_path, err in failures:
+            fail('\t' + input_path + ': ' + err)
+        sys.exit(1)
+    
     return
 
-def full_day_convert(in_dir, out_dir):
+def full_day_convert(in_dir, out_dir, workers=1, chunksize=1):
+    """Convert every capture directory in in_dir, fanning out over a process pool when workers > 1.
+
+    GeoTIFF paths are written to tif_list.txt by this (parent) process in directory
+    order, regardless of which worker finished first. Returns the list of
+    (input directory, error message) pairs for captures that failed.
+    """
     
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
@@ -105,24 +128,55 @@ def full_day_convert(in_dir, out_dir):
     except OSError:
         pass
     
-    list_dirs = os.walk(in_dir)
+    tasks = []
+    for input_path, metafile, binfile in find_capture_dirs(in_dir):
+        output_path = os.path.join(out_dir, os.path.basename(input_path))
+        tasks.append((input_path, output_path, metafile, binfile))
     
-    for root, dirs, files in list_dirs:
-        for d in dirs:
-            input_path = os.path.join(in_dir, d)
-            output_path = os.path.join(out_dir, d)
-            if not os.path.isdir(input_path):
-                continue
-            
-            try:
-                get_flir(input_path, output_path, tif_list_file)
-            except Exception as ex:
-                fail('Error processing flir data in: ' + input_path + str(ex))
+    if workers > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.imap(convert_capture, tasks, chunksize)
+            failures = write_tif_list(results, tif_list_file)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        failures = write_tif_list((convert_capture(t) for t in tasks), tif_list_file)
     
-    return
+    for input_path, err in failures:
+        fail('Error processing flir data in: ' + input_path + ': ' + err)
+    if failures:
+        fail('%s of %s capture directories failed' % (len(failures), len(tasks)))
+    
+    return failures
+
+def convert_capture(task):
+    """Pool worker: run get_flir for one discovered capture directory.
+
+    Returns (input directory, GeoTIFF path or None, error message or None) so
+    failures are reported back to the parent instead of only printed.
+    """
+    input_path, output_path, metafile, binfile = task
+    try:
+        return input_path, get_flir(input_path, output_path, metafile, binfile), None
+    except Exception as ex:
+        return input_path, None, '%s: %s' % (type(ex).__name__, str(ex))
+
+def write_tif_list(results, tif_list_file):
+    # once we've saved the images, make sure to append the paths to our list of TIFs
+    failures = []
+    with open(tif_list_file, 'a+') as f:
+        for input_path, tif_path, err in results:
+            if err is not None:
+                failures.append((input_path, err))
+            elif tif_path is not None:
+                f.write(tif_path + '\n')
+    return failures
 
 
-def get_flir(in_dir, out_dir, tif_list_file):
+def get_flir(in_dir, out_dir, metafile=None, binfile=None):
     
     if not os.path.exists(out_dir):
         try:
@@ -130,9 +184,11 @@ def get_flir(in_dir, out_dir, tif_list_file):
         except:
             fail('Failed to create directory in ' + out_dir)
     
-    metafile, binfile = find_files(in_dir)
-    if metafile == [] or binfile == [] :
-        return
+    # files already found by find_capture_dirs don't need another directory listing
+    if metafile is None or binfile is None:
+        metafile, binfile = find_files(in_dir)
+        if metafile == [] or binfile == [] :
+            return None
     
     metadata = lower_keys(load_json(metafile)) # load json file
     
@@ -152,26 +208,32 @@ def get_flir(in_dir, out_dir, tif_list_file):
     gmax = 18000
     im_color = flir_data_visualization(raw_data, out_png, gmin, gmax) # create png
     
-    tc = rawData_to_temperature(raw_data, scan_time, metadata) # get temperature
+    tc = rawData_to_temperature(raw_data, metadata, lut=True) # get temperature
     
     tif_path = temp_name[:-3] + 'tif'
     
     create_geotiff_with_temperature(im_color, tc, gps_bounds, tif_path) # create geotiff
     
-    # once we've saved the image, make sure to append this path to our list of TIFs
-    f = open(tif_list_file,'a+')
-    f.write(tif_path + '\n')
-    
-    return
+    return tif_path
+
 
+def rawData_to_temperature(rawData, metadata, lut=False):
+    """Convert raw FLIR counts to temperature.
 
-def rawData_to_temperature(rawData, metadata):
+    With lut=True the frame is converted with a single gather from a 65,536-entry
+    float32 table (see get_temperature_lut); rawData should then be the uint16
+    frame as read from the bin file.
+    """
     try:
         calibP = get_calibrate_param(metadata)
-        tc = np.zeros((640, 480))
-        
-        if calibP.calibrated:
-            tc = rawData/10
+
+        if lut:
+            if rawData.dtype != np.uint16:
+                rawData = rawData.astype('<u2')
+            tc = np.take(get_temperature_lut(calibP), rawData)
+        elif calibP.calibrated:
+            # rawData may be the uint16 frame; / 10 would floor-divide it under Python 2
+            tc = rawData/10.0
         else:
             tc = flirRawToTemperature(rawData, calibP)
 
@@ -206,6 +268,7 @@ def get_calibrate_param(metadata):
     
 
 def create_geotiff_with_temperature(np_arr, temp_arr, gps_bounds, out_file_path):
+    from osgeo import gdal, osr
     try:
         nrows, ncols, channels = np.shape(np_arr)
         xres = (gps_bounds[3] - gps_bounds[2])/float(ncols)
@@ -244,6 +307,7 @@ def create_geotiff_with_temperature(np_arr, temp_arr, gps_bounds, out_file_path)
     return
 
 def create_geotiff(np_arr, gps_bounds, out_file_path):
+    from osgeo import gdal, osr
     try:
         nrows,ncols = np.shape(np_arr)
         # gps_bounds: (lat_min, lat_max, lng_min, lng_max)
@@ -279,81 +343,170 @@ def create_geotiff(np_arr, gps_bounds, out_file_path):
 def load_flir_data(file_path):
     
     try:
-        im = np.fromfile(file_path, np.dtype('<u2')).reshape([480, 640])
-        im = im.astype('float')
-        im = np.rot90(im, 3)   # rotate 90 degree to fit camera position
-        return im
+        # memory-mapped uint16 view, already rotated 90 degree to fit camera position
+        return open_flir_bin(file_path)
     except Exception as ex:
         fail('Error loading bin file' + str(ex))
         
+# matplotlib 'jet' segment data: (x, value) anchors per channel
+JET_SEGMENTS = (
+    ((0.0, 0.0), (0.35, 0.0), (0.66, 1.0), (0.89, 1.0), (1.0, 0.5)),
+    ((0.0, 0.0), (0.125, 0.0), (0.375, 1.0), (0.64, 1.0), (0.91, 0.0), (1.0, 0.0)),
+    ((0.0, 0.5), (0.11, 1.0), (0.34, 1.0), (0.65, 0.0), (1.0, 0.0)),
+)
+
+def build_jet_lut(N=256):
+    """Return the N-entry RGBA uint8 jet colormap, byte-identical to matplotlib's cm.jet."""
+    x = np.linspace(0.0, 1.0, N)
+    lut = np.ones((N, 4))
+    for channel, anchors in enumerate(JET_SEGMENTS):
+        lut[:, channel] = np.interp(x, [a[0] for a in anchors], [a[1] for a in anchors])
+    return (lut*255).astype('uint8')
+
+JET_LUT = build_jet_lut()
+
+def colorize(im, Gmin, Gmax):
+    """Map im linearly from [Gmin, Gmax] through JET_LUT into an RGBA uint8 array."""
+    N = len(JET_LUT)
+    # a uniform frame has no range to stretch; every pixel gets the lowest colour
+    scale = N/float(Gmax - Gmin) if Gmax != Gmin else 0.0
+    if im.dtype == np.uint16:
+        # one gather through a 65,536-entry colour table for this frame's range
+        raw_values = np.arange(65536, dtype='float64')
+        index = ((raw_values-Gmin)*scale).astype('int64')
+        np.clip(index, 0, N-1, out=index)
+        return np.take(JET_LUT[index], im, axis=0)
+
+    index = ((im-Gmin)*scale).astype('int64')
+    np.clip(index, 0, N-1, out=index)
+    return np.take(JET_LUT, index, axis=0)
+
 def flir_data_visualization(im, outfile_path, Gmin, Gmax):
+    """Write the jet-coloured PNG for im and return the RGBA array that was written."""
+    from PIL import Image
     
     Gmin = im.min()
     Gmax = im.max()
-    At = (im-Gmin)/(Gmax - Gmin)
-    
-    my_cmap = cm.get_cmap('jet')
-    color_array = my_cmap(At)
-    
-    plt.imsave(outfile_path, color_array)
+    color_array = colorize(im, Gmin, Gmax)
     
-    img_data = Image.open(outfile_path)
+    Image.fromarray(color_array, 'RGBA').save(outfile_path)
     
-    return np.array(img_data)
+    return color_array
         
+# atmospheric constants used by the FLIR radiometric model
+H2O_K1 = 1.56
+H2O_K2 = 0.0694
+H2O_K3 = -0.000278
+H2O_K4 = 0.000000685
+
+AMB_HUMIDITY = 0.1
+AMB_TEMP = 22.0
+OBJ_DISTANCE = 2.5
+OBJ_EMISSIVITY = 0.98
+
+K0 = 273.15
+
+# compiled coefficients, keyed by the calibration values they were built from
+_calib_coeff_cache = {}
+# raw count -> temperature tables, keyed by calibration flag and values
+_temperature_lut_cache = {}
+
+class calibCoeffs:
+    """Scalar coefficients of the radiometric model for one calibration set.
+
+    The model reduces to pxl_temp = B / log(RJ1 / (gain*raw + offset) + F), so
+    every atmospheric term is folded into gain and offset once per calibration.
+    """
+    def __init__(self, calibP):
+        R = calibP.calibrationR
+        B = calibP.calibrationB
+        F = calibP.calibrationF
+        J0 = calibP.calibrationJ0
+        J1 = calibP.calibrationJ1
+
+        X = calibP.calibrationX
+        a1 = calibP.calibrationa1
+        b1 = calibP.calibrationb1
+        a2 = calibP.calibrationa2
+        b2 = calibP.calibrationb2
+
+        H = AMB_HUMIDITY
+        T = AMB_TEMP
+        D = OBJ_DISTANCE
+        E = OBJ_EMISSIVITY
+
+        AmbTemp = T + K0
+        AtmTemp = T + K0
+
+        H2OInGperM2 = H*math.exp(H2O_K1 + H2O_K2*T + H2O_K3*math.pow(T, 2) + H2O_K4*math.pow(T, 3))
+        a1b1sqH2O = (a1+b1*math.sqrt(H2OInGperM2))
+        a2b2sqH2O = (a2+b2*math.sqrt(H2OInGperM2))
+        exp1 = math.exp(-math.sqrt(D/2)*a1b1sqH2O)
+        exp2 = math.exp(-math.sqrt(D/2)*a2b2sqH2O)
+
+        tao = X*exp1 + (1-X)*exp2
+
+        theo_atm_rad = (R*J1/(math.exp(B/AtmTemp)-F)) + J0
+        atm_rad = (1-tao)*theo_atm_rad
+
+        theo_amb_refl_rad = (R*J1/(math.exp(B/AmbTemp)-F)) + J0
+        amb_refl_rad = (1-E)*tao*theo_amb_refl_rad
+
+        # corr_pxl_val - J0 = raw*E*tao + atm_rad + amb_refl_rad - J0
+        self.gain = E*tao
+        self.offset = atm_rad + amb_refl_rad - J0
+        self.RJ1 = R*J1
+        self.F = F
+        self.B = B
+
+def calib_key(calibP):
+    return (calibP.calibrationR, calibP.calibrationB, calibP.calibrationF,
+            calibP.calibrationJ0, calibP.calibrationJ1, calibP.calibrationX,
+            calibP.calibrationa1, calibP.calibrationb1, calibP.calibrationa2, calibP.calibrationb2)
+
+def compile_calibration(calibP):
+    """Return the cached calibCoeffs for this calibration set, building it on first use."""
+    key = calib_key(calibP)
+    coeffs = _calib_coeff_cache.get(key)
+    if coeffs is None:
+        coeffs = calibCoeffs(calibP)
+        _calib_coeff_cache[key] = coeffs
+    return coeffs
+
+def get_temperature_lut(calibP):
+    """Return the cached float32 temperature for every possible 16-bit raw value."""
+    key = (calibP.calibrated,) + calib_key(calibP)
+    lut = _temperature_lut_cache.get(key)
+    if lut is None:
+        raw_values = np.arange(65536, dtype='float64')
+        if calibP.calibrated:
+            lut = (raw_values/10).astype('float32')
+        else:
+            # raw values far outside the sensor range have no defined temperature
+            with np.errstate(divide='ignore', invalid='ignore'):
+                lut = flirRawToTemperature(raw_values, calibP).astype('float32')
+        _temperature_lut_cache[key] = lut
+    return lut
+
 # convert flir raw data into temperature C degree, for date after September 15th
-def flirRawToTemperature(rawData, calibP):
-    
-    R = calibP.calibrationR
-    B = calibP.calibrationB
-    F = calibP.calibrationF
-    J0 = calibP.calibrationJ0
-    J1 = calibP.calibrationJ1
-    
-    X = calibP.calibrationX
-    a1 = calibP.calibrationa1
-    b1 = calibP.calibrationb1
-    a2 = calibP.calibrationa2
-    b2 = calibP.calibrationb2
-    
-    H2O_K1 = 1.56
-    H2O_K2 = 0.0694
-    H2O_K3 = -0.000278
-    H2O_K4 = 0.000000685
-    
-    H = 0.1
-    T = 22.0
-    D = 2.5
-    E = 0.98
-    
-    K0 = 273.15
-    
-    im = rawData
-        
-    AmbTemp = T + K0
-    AtmTemp = T + K0
-        
-    H2OInGperM2 = H*math.exp(H2O_K1 + H2O_K2*T + H2O_K3*math.pow(T, 2) + H2O_K4*math.pow(T, 3))
-    a1b1sqH2O = (a1+b1*math.sqrt(H2OInGperM2))
-    a2b2sqH2O = (a2+b2*math.sqrt(H2OInGperM2))
-    exp1 = math.exp(-math.sqrt(D/2)*a1b1sqH2O)
-    exp2 = math.exp(-math.sqrt(D/2)*a2b2sqH2O)
-        
-    tao = X*exp1 + (1-X)*exp2
-        
-    obj_rad = im*E*tao
-        
-    theo_atm_rad = (R*J1/(math.exp(B/AtmTemp)-F)) + J0
-    atm_rad = repmat((1-tao)*theo_atm_rad, 640, 480)
-        
-    theo_amb_refl_rad = (R*J1/(math.exp(B/AmbTemp)-F)) + J0
-    amb_refl_rad = repmat((1-E)*tao*theo_amb_refl_rad, 640, 480)
-        
-    corr_pxl_val = obj_rad + atm_rad + amb_refl_rad
-        
-    pxl_temp = B/np.log(R/(corr_pxl_val-J0)*J1+F)
-    
-    return pxl_temp
+def flirRawToTemperature(rawData, calibP, out=None):
+    """Apply the radiometric model to rawData.
+
+    out may be a float array of the same shape to write into (including rawData
+    itself for an in-place conversion); otherwise a new float64 array is returned.
+    """
+    c = compile_calibration(calibP)
+
+    if out is None:
+        out = np.empty(np.shape(rawData), dtype='float64')
+    np.multiply(rawData, c.gain, out=out)
+    out += c.offset
+    np.divide(c.RJ1, out, out=out)
+    out += c.F
+    np.log(out, out=out)
+    np.divide(c.B, out, out=out)
+
+    return out
 
 def get_bounding_box(center_position, fov):
     # NOTE: ZERO_ZERO is the southeast corner of the field. Position values increase to the northwest (so +y-position = +latitude, or more north and +x-position = -longitude, or more west)
@@ -397,8 +550,10 @@ def get_bounding_box_with_formula(center_position, fov):
     Mx_se = ax + bx * x_s + cx * y_e
     My_se = ay + by * x_s + cy * y_e
     
-    fov_nw_latlon = utm.to_latlon(Mx_nw, My_nw, SE_utm[2],SE_utm[3])
-    fov_se_latlon = utm.to_latlon(Mx_se, My_se, SE_utm[2],SE_utm[3])
+    import utm
+    se_utm = get_SE_utm()
+    fov_nw_latlon = utm.to_latlon(Mx_nw, My_nw, se_utm[2],se_utm[3])
+    fov_se_latlon = utm.to_latlon(Mx_se, My_se, se_utm[2],se_utm[3])
     
     return (fov_se_latlon[0] - lat_shift, fov_nw_latlon[0] - lat_shift, fov_nw_latlon[1] + lon_shift, fov_se_latlon[1] + lon_shift)
 
@@ -463,21 +618,17 @@ def load_json(meta_path):
         fail('Corrupt metadata file, ' + str(ex))
 
 def find_files(in_dir):
-    json_suffix = os.path.join(in_dir, '*_metadata.json')
-    jsons = glob(json_suffix)
-    if len(jsons) == 0:
+    metafile, binfile, child_dirs = scan_capture_dir(in_dir)
+    if metafile is None:
         fail('Could not find .json file')
         return [], []
         
-        
-    bin_suffix = os.path.join(in_dir, '*_ir.bin')
-    bins = glob(bin_suffix)
-    if len(bins) == 0:
+    if binfile is None:
         fail('Could not find .bin file')
         return [], []
     
     
-    return jsons[0], bins[0]
+    return metafile, binfile
 
 def createVrt(base_dir,tif_file_list):
     # Create virtual tif for the files in this folder
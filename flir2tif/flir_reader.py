@@ -0,0 +1,81 @@
+'''
+Zero-copy access to FLIR _ir.bin frames
+
+Frames are memory-mapped as uint16 and rotated to camera orientation with a
+view, so no pixel data is read or copied until a caller actually uses it.
+
+A day of captures is found with find_capture_dirs and converted one capture at
+a time, each frame mapped with open_flir_bin; there is no stacked day array,
+since no conversion path needs more than one frame at once.
+'''
+
+import os
+import numpy as np
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 needs the scandir backport, which the terrautils image may not have
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+FLIR_HEIGHT = 480
+FLIR_WIDTH = 640
+FLIR_DTYPE = np.dtype('<u2')
+FLIR_BIN_SUFFIX = '_ir.bin'
+FLIR_METADATA_SUFFIX = '_metadata.json'
+
+
+def open_flir_bin(file_path):
+    """Memory-map an _ir.bin file and return a read-only (640, 480) uint16 view.
+
+    The view is rotated 90 degrees to fit the camera position, matching what
+    load_flir_data used to produce with numpy.fromfile + rot90.
+    """
+    raw = np.memmap(file_path, dtype=FLIR_DTYPE, mode='r', shape=(FLIR_HEIGHT, FLIR_WIDTH))
+    return np.rot90(raw, 3)
+
+
+def list_dir(in_dir):
+    """Return (name, path, is directory) for the entries of in_dir, sorted by name."""
+    if scandir is not None:
+        return sorted((e.name, e.path, e.is_dir()) for e in scandir(in_dir))
+    # without scandir every entry costs an extra stat
+    return [(name, os.path.join(in_dir, name), os.path.isdir(os.path.join(in_dir, name)))
+            for name in sorted(os.listdir(in_dir))]
+
+
+def scan_capture_dir(in_dir):
+    """List in_dir once and return (metadata json, bin file, child directories).
+
+    The first matching file in name order is returned for each suffix, or None
+    if the directory holds no such file.
+    """
+    metafile, binfile, child_dirs = None, None, []
+    for name, path, is_dir in list_dir(in_dir):
+        if is_dir:
+            child_dirs.append(path)
+        elif metafile is None and name.endswith(FLIR_METADATA_SUFFIX):
+            metafile = path
+        elif binfile is None and name.endswith(FLIR_BIN_SUFFIX):
+            binfile = path
+    return metafile, binfile, child_dirs
+
+
+def find_capture_dirs(in_dir):
+    """Yield (capture directory, metadata json, bin file) for every directory below in_dir
+    that contains both a *_metadata.json and an *_ir.bin file.
+
+    Each directory is listed exactly once; directories are visited in name order.
+    """
+    pending = [in_dir]
+    while pending:
+        current = pending.pop()
+        metafile, binfile, child_dirs = scan_capture_dir(current)
+        if metafile is not None and binfile is not None:
+            yield current, metafile, binfile
+        # reversed so the stack pops children in name order
+        pending.extend(reversed(child_dirs))
+
@@ -2,30 +2,53 @@
 
 import os
 import shutil
-import numpy
 import tempfile
+import multiprocessing
 
 from pyclowder.utils import CheckMessage
 from pyclowder.files import upload_to_dataset
-from pyclowder.datasets import download_metadata, upload_metadata, remove_metadata, submit_extraction
+from pyclowder.datasets import download_metadata, upload_metadata, remove_metadata, submit_extraction, \
+    get_info, get_file_list
 from terrautils.metadata import get_extractor_metadata, get_terraref_metadata, calculate_scan_time, \
     get_season_and_experiment
 from terrautils.extractors import TerrarefExtractor, is_latest_file, check_file_in_dataset, \
-    build_dataset_hierarchy_crawl, build_metadata, load_json_file, file_exists, contains_required_files
-from terrautils.formats import create_geotiff, create_image
-from terrautils.spatial import geojson_to_tuples, geojson_to_tuples_betydb
-from terrautils.betydb import add_arguments, get_site_boundaries
+    build_metadata, load_json_file, file_exists, contains_required_files, delete_file
+from terrautils.spatial import geojson_to_tuples
+from terrautils.betydb import add_arguments
 
 import Get_FLIR as getFlir
+from flir_reader import open_flir_bin
+from hierarchy_cache import resolve_dataset, invalidate_on_404
 
 
 def add_local_arguments(parser):
     # add any additional arguments to parser
     parser.add_argument('--scale', dest="scale_values", type=bool, nargs='?', default=True,
                         help="scale individual flir images based on px range as opposed to full field stitch")
+    parser.add_argument('--batch-workers', dest="batch_workers", type=int, default=multiprocessing.cpu_count(),
+                        help="worker processes used to convert frames of a batch request")
 
     add_arguments(parser)
 
+def convert_frame(job):
+    """Create the PNG and/or GeoTIFF for one raw frame; runs in a batch worker process.
+
+    Returns the job with the sizes of the files that were created.
+    """
+    # formats pulls in matplotlib and netCDF4; only import it once there is a frame to convert
+    from terrautils.formats import create_geotiff, create_image
+
+    raw_data = open_flir_bin(job['bin_file'])
+    job['created'] = []
+    if job['make_png']:
+        create_image(raw_data.astype('float'), job['png_path'], job['scale_values'])
+        job['created'].append(os.path.getsize(job['png_path']))
+    if job['make_tiff']:
+        tc = getFlir.rawData_to_temperature(raw_data, job['terra_md'], lut=True)
+        create_geotiff(tc, job['gps_bounds'], job['tiff_path'], None, True, job['extractor_info'], job['terra_md'])
+        job['created'].append(os.path.getsize(job['tiff_path']))
+    return job
+
 class FlirBin2JpgTiff(TerrarefExtractor):
     def __init__(self):
         super(FlirBin2JpgTiff, self).__init__()
@@ -37,8 +60,13 @@ class FlirBin2JpgTiff(TerrarefExtractor):
 
         # assign other arguments
         self.scale_values = self.args.scale_values
+        self.batch_workers = self.args.batch_workers
 
     def check_message(self, connector, host, secret_key, resource, parameters):
+        if "batch_datasets" in parameters:
+            # Batch requests carry their own dataset list; files are read from the mounted raw_data
+            return CheckMessage.bypass
+
         if "rulechecked" in parameters and parameters["rulechecked"]:
             return CheckMessage.download
 
@@ -70,6 +98,12 @@ class FlirBin2JpgTiff(TerrarefExtractor):
             return CheckMessage.ignore
 
     def process_message(self, connector, host, secret_key, resource, parameters):
+        # formats pulls in matplotlib and netCDF4; only import it once there is a frame to convert
+        from terrautils.formats import create_geotiff, create_image
+
+        if "batch_datasets" in parameters:
+            return self.process_batch(connector, host, secret_key, resource, parameters["batch_datasets"])
+
         self.start_message(resource)
 
         # Get BIN file and metadata
@@ -93,17 +127,17 @@ class FlirBin2JpgTiff(TerrarefExtractor):
         # Determine output directory
         self.log_info(resource, "Hierarchy: %s / %s / %s / %s / %s / %s / %s" % (season_name, experiment_name, self.sensors.get_display_name(),
                                                                                  timestamp[:4], timestamp[5:7], timestamp[8:10], timestamp))
-        target_dsid = build_dataset_hierarchy_crawl(host, secret_key, self.clowder_user, self.clowder_pass, self.clowderspace,
-                                              season_name, experiment_name, self.sensors.get_display_name(),
-                                              timestamp[:4], timestamp[5:7], timestamp[8:10],
-                                              leaf_ds_name=self.sensors.get_display_name()+' - '+timestamp)
+        target_dsid = resolve_dataset(host, secret_key, self.clowder_user, self.clowder_pass, self.clowderspace,
+                                      season_name, experiment_name, self.sensors.get_display_name(), timestamp[:10],
+                                      self.sensors.get_display_name()+' - '+timestamp)
         tiff_path = self.sensors.create_sensor_path(timestamp)
         png_path = tiff_path.replace(".tif", ".png")
         uploaded_file_ids = []
 
         # Attach LemnaTec source metadata to Level_1 product
         self.log_info(resource, "uploading LemnaTec metadata to ds [%s]" % target_dsid)
-        remove_metadata(connector, host, secret_key, target_dsid, self.extractor_info['name'])
+        with invalidate_on_404(target_dsid):
+            remove_metadata(connector, host, secret_key, target_dsid, self.extractor_info['name'])
         terra_md_trim = get_terraref_metadata(all_dsmd)
         if updated_experiment is not None:
             terra_md_trim['experiment_metadata'] = updated_experiment
@@ -111,17 +145,15 @@ class FlirBin2JpgTiff(TerrarefExtractor):
         level1_md = build_metadata(host, self.extractor_info, target_dsid, terra_md_trim, 'dataset')
         upload_metadata(connector, host, secret_key, target_dsid, level1_md)
 
-        skipped_png = False
+        # Memory-mapped uint16 frame; pixels are only read by the outputs that need them
+        raw_data = open_flir_bin(bin_file)
+
         if not file_exists(png_path) or self.overwrite:
             # Perform actual processing
             self.log_info(resource, "creating & uploading %s" % png_path)
-            raw_data = numpy.fromfile(bin_file, numpy.dtype('<u2')).reshape([480, 640]).astype('float')
-            raw_data = numpy.rot90(raw_data, 3)
-            create_image(raw_data, png_path, self.scale_values)
+            create_image(raw_data.astype('float'), png_path, self.scale_values)
             self.created += 1
             self.bytes += os.path.getsize(png_path)
-        else:
-            skipped_png = True
         # Only upload the newly generated file to Clowder if it isn't already in dataset
         found_in_dest = check_file_in_dataset(connector, host, secret_key, target_dsid, png_path, remove=self.overwrite)
         if not found_in_dest or self.overwrite:
@@ -132,10 +164,7 @@ class FlirBin2JpgTiff(TerrarefExtractor):
             # Generate temperature matrix and perform actual processing
             self.log_info(resource, "creating & uploading %s" % tiff_path)
             gps_bounds = geojson_to_tuples(terra_md_full['spatial_metadata']['flirIrCamera']['bounding_box'])
-            if skipped_png:
-                raw_data = numpy.fromfile(bin_file, numpy.dtype('<u2')).reshape([480, 640]).astype('float')
-                raw_data = numpy.rot90(raw_data, 3)
-            tc = getFlir.rawData_to_temperature(raw_data, terra_md_full) # get temperature
+            tc = getFlir.rawData_to_temperature(raw_data, terra_md_full, lut=True) # get temperature
             create_geotiff(tc, gps_bounds, tiff_path, None, True, self.extractor_info, terra_md_full)
             self.created += 1
             self.bytes += os.path.getsize(tiff_path)
@@ -160,6 +189,155 @@ class FlirBin2JpgTiff(TerrarefExtractor):
 
         self.end_message(resource)
 
+    def process_batch(self, connector, host, secret_key, resource, dataset_ids):
+        """Convert a list of raw FLIR datasets (e.g. one gantry scan) in one pass.
+
+        Triggered by a message whose parameters contain "batch_datasets": [dataset ids].
+        Frames are converted in a pool of self.batch_workers processes. The season /
+        experiment / sensor / date collections are resolved once per day rather than
+        once per frame, and each Level_1 dataset's file list is fetched once.
+        """
+        self.start_message(resource)
+
+        frames = []
+        for dsid in dataset_ids:
+            frame = self.load_batch_frame(connector, host, secret_key, dsid)
+            if frame is not None:
+                frames.append(frame)
+        self.log_info(resource, "batch of %s datasets, %s with raw data" % (len(dataset_ids), len(frames)))
+
+        # Each day's collections are resolved once (and cached), then only the leaf datasets per frame
+        days = set()
+        sensor_name = self.sensors.get_display_name()
+        for frame in frames:
+            timestamp = frame['timestamp']
+            day_key = (frame['season'], frame['experiment'], timestamp[:10])
+            if day_key not in days:
+                self.log_info(resource, "Hierarchy: %s / %s / %s / %s" % (frame['season'], frame['experiment'],
+                                                                          sensor_name, timestamp[:10]))
+                days.add(day_key)
+            frame['target_dsid'] = resolve_dataset(host, secret_key, self.clowder_user, self.clowder_pass, self.clowderspace,
+                                                   frame['season'], frame['experiment'], sensor_name, timestamp[:10],
+                                                   sensor_name+' - '+timestamp)
+
+        # Convert all frames that need outputs
+        jobs = []
+        for frame in frames:
+            tiff_path = self.sensors.create_sensor_path(frame['timestamp'])
+            png_path = tiff_path.replace(".tif", ".png")
+            frame['outputs'] = [png_path, tiff_path]
+            job = {
+                'bin_file': frame['bin_file'],
+                'png_path': png_path,
+                'tiff_path': tiff_path,
+                'make_png': not file_exists(png_path) or self.overwrite,
+                'make_tiff': not file_exists(tiff_path) or self.overwrite,
+                'scale_values': self.scale_values,
+                'gps_bounds': geojson_to_tuples(frame['terra_md']['spatial_metadata']['flirIrCamera']['bounding_box']),
+                'terra_md': frame['terra_md'],
+                'extractor_info': self.extractor_info
+            }
+            if job['make_png'] or job['make_tiff']:
+                jobs.append(job)
+
+        if len(jobs) > 0:
+            self.log_info(resource, "converting %s frames with %s workers" % (len(jobs), self.batch_workers))
+            if self.batch_workers > 1:
+                pool = multiprocessing.Pool(self.batch_workers)
+                try:
+                    results = pool.map(convert_frame, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [convert_frame(job) for job in jobs]
+            for job in results:
+                self.created += len(job['created'])
+                self.bytes += sum(job['created'])
+
+        # Clowder updates per frame, reusing the resolved hierarchy
+        for frame in frames:
+            target_dsid = frame['target_dsid']
+
+            # Attach LemnaTec source metadata to Level_1 product
+            with invalidate_on_404(target_dsid):
+                remove_metadata(connector, host, secret_key, target_dsid, self.extractor_info['name'])
+            terra_md_trim = get_terraref_metadata(frame['all_dsmd'])
+            if frame['updated_experiment'] is not None:
+                terra_md_trim['experiment_metadata'] = frame['updated_experiment']
+            terra_md_trim['raw_data_source'] = host + ("" if host.endswith("/") else "/") + "datasets/" + frame['id']
+            level1_md = build_metadata(host, self.extractor_info, target_dsid, terra_md_trim, 'dataset')
+            upload_metadata(connector, host, secret_key, target_dsid, level1_md)
+
+            uploaded_file_ids = self.upload_missing_files(connector, host, secret_key, target_dsid, frame['outputs'])
+
+            submit_extraction(connector, host, secret_key, target_dsid, "terra.plotclipper_tif")
+
+            # Tell Clowder this is completed so subsequent file updates don't daisy-chain
+            if len(uploaded_file_ids) > 0:
+                extractor_md = build_metadata(host, self.extractor_info, target_dsid, {
+                    "files_created": uploaded_file_ids
+                }, 'dataset')
+                remove_metadata(connector, host, secret_key, frame['id'], self.extractor_info['name'])
+                upload_metadata(connector, host, secret_key, frame['id'], extractor_md)
+
+        self.end_message(resource)
+
+    def load_batch_frame(self, connector, host, secret_key, dsid):
+        """Collect the raw bin file and metadata of one batch dataset, or None if it can't be processed."""
+        ds_info = get_info(connector, host, secret_key, dsid)
+        all_dsmd = download_metadata(connector, host, secret_key, dsid)
+        terra_md_full = get_terraref_metadata(all_dsmd, 'flirIrCamera')
+        if not terra_md_full:
+            self.log_error(ds_info, "no terraref metadata found; skipping in batch")
+            return None
+
+        bin_file = None
+        for f in get_file_list(connector, host, secret_key, dsid):
+            if f['filename'].endswith('_ir.bin'):
+                bin_file = f['filepath']
+                for source_path in connector.mounted_paths:
+                    if bin_file.startswith(source_path):
+                        bin_file = bin_file.replace(source_path, connector.mounted_paths[source_path])
+                break
+        if bin_file is None or not os.path.isfile(bin_file):
+            self.log_error(ds_info, "raw _ir.bin file is not available locally; skipping in batch")
+            return None
+
+        timestamp = ds_info['name'].split(" - ")[1]
+        season_name, experiment_name, updated_experiment = get_season_and_experiment(timestamp, 'flirIrCamera', terra_md_full)
+        if None in [season_name, experiment_name]:
+            self.log_error(ds_info, "season and experiment could not be determined; skipping in batch")
+            return None
+
+        return {
+            'id': dsid,
+            'timestamp': timestamp,
+            'bin_file': bin_file,
+            'all_dsmd': all_dsmd,
+            'terra_md': terra_md_full,
+            'season': season_name,
+            'experiment': experiment_name,
+            'updated_experiment': updated_experiment
+        }
+
+    def upload_missing_files(self, connector, host, secret_key, target_dsid, file_paths):
+        """Upload file_paths not yet in target_dsid using a single listing of the dataset."""
+        dest_files = get_file_list(connector, host, secret_key, target_dsid)
+        uploaded_file_ids = []
+        for file_path in file_paths:
+            filename = os.path.basename(file_path)
+            found_in_dest = False
+            for f in dest_files:
+                if f['filename'] == filename:
+                    if self.overwrite:
+                        delete_file(host, secret_key, f['id'])
+                    found_in_dest = True
+            if not found_in_dest or self.overwrite:
+                fileid = upload_to_dataset(connector, host, secret_key, target_dsid, file_path)
+                uploaded_file_ids.append(host + ("" if host.endswith("/") else "/") + "files/" + fileid)
+        return uploaded_file_ids
+
 if __name__ == "__main__":
     extractor = FlirBin2JpgTiff()
     extractor.start()
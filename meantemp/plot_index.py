@@ -0,0 +1,99 @@
+'''
+Cached plot-boundary geometry for meantemp
+
+BETYdb plot boundaries only change a few times a season, so they are fetched
+and parsed once per date into compact arrays, kept in memory and persisted to
+a local .npz file that later messages (and restarted extractors) reuse.
+'''
+
+import os
+import json
+import yaml
+import numpy as np
+
+
+class PlotIndex(object):
+    """Plot names, bounding boxes and centroids as arrays, with a bounding-box spatial index.
+
+    bounds rows are (lat min, lat max, long min, long max) as returned by
+    geojson_to_tuples_betydb; centroids rows are (long, lat).
+    """
+
+    def __init__(self, names, bounds, centroids):
+        self.names = np.asarray(names)
+        self.bounds = np.asarray(bounds, dtype='float64').reshape(-1, 4)
+        self.centroids = np.asarray(centroids, dtype='float64').reshape(-1, 2)
+
+        # plots ordered by western edge; query() cuts this with a binary search
+        self._order = np.argsort(self.bounds[:, 2], kind='mergesort')
+        self._sorted_min_x = self.bounds[self._order, 2]
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_boundaries(cls, boundaries, exclude=None):
+        """Parse the {plotname: geojson} dict returned by terrautils.betydb.get_site_boundaries.
+
+        Plots whose name contains any string in exclude are left out.
+        """
+        from terrautils.spatial import geojson_to_tuples_betydb, centroid_from_geojson
+
+        names, bounds, centroids = [], [], []
+        for plotname in sorted(boundaries):
+            if exclude and any(plotname.find(e) > -1 for e in exclude):
+                continue
+            geojson = boundaries[plotname]
+            names.append(plotname)
+            bounds.append(geojson_to_tuples_betydb(yaml.safe_load(geojson)))
+            centroids.append(json.loads(centroid_from_geojson(geojson))["coordinates"][:2])
+        return cls(names, bounds, centroids)
+
+    def query(self, extent):
+        """Return the indices, in plot order, of plots whose bounding box intersects extent.
+
+        extent is (lat min, lat max, long min, long max), e.g. a raster's footprint.
+        """
+        min_y, max_y, min_x, max_x = extent
+        candidates = self._order[:np.searchsorted(self._sorted_min_x, max_x, side='right')]
+        b = self.bounds[candidates]
+        hit = (b[:, 3] >= min_x) & (b[:, 0] <= max_y) & (b[:, 1] >= min_y)
+        return np.sort(candidates[hit])
+
+    def save(self, path):
+        tmp_path = path + '.%s.tmp.npz' % os.getpid()
+        np.savez(tmp_path, names=self.names, bounds=self.bounds, centroids=self.centroids)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['names'], data['bounds'], data['centroids'])
+
+
+# PlotIndex per cache key, reused across messages in this process
+_plot_indexes = {}
+
+def get_plot_index(date, city, cache_dir=None, exclude=None):
+    """Return the PlotIndex of plots active on date (YYYY-MM-DD) in city.
+
+    Looks in memory, then in cache_dir, and only queries BETYdb when neither has it.
+    """
+    key = "%s_%s" % (city, date)
+    if key in _plot_indexes:
+        return _plot_indexes[key]
+
+    cache_path = os.path.join(cache_dir, "plot_index_%s.npz" % key) if cache_dir else None
+    if cache_path and os.path.isfile(cache_path):
+        index = PlotIndex.load(cache_path)
+    else:
+        from terrautils.betydb import get_site_boundaries
+
+        index = PlotIndex.from_boundaries(get_site_boundaries(date, city=city), exclude)
+        if cache_path:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            index.save(cache_path)
+
+    _plot_indexes[key] = index
+    return index
@@ -0,0 +1,61 @@
+'''
+Per-plot checksums and statistics from the last meantemp run on a mosaic
+
+Stored as JSON next to the output CSVs so a re-stitched mosaic only needs the
+plots whose pixels or boundaries changed to be recomputed and resubmitted.
+'''
+
+import os
+import json
+
+
+def load_plot_state(path, stat_names):
+    """Return {plot name: {'bounds', 'checksum', 'values'}} saved at path.
+
+    Returns None if there is no usable state, including state saved for a
+    different set of statistics.
+    """
+    try:
+        with open(path, 'r') as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if state.get('stats') != list(stat_names):
+        return None
+    return state.get('plots')
+
+
+def known_checksums(previous, names, bounds):
+    """{plot name: checksum} of previous plots whose boundaries are still the same."""
+    known = {}
+    if previous:
+        for name, plot_bounds in zip(names, bounds):
+            plot = previous.get(name)
+            if plot is not None and plot['bounds'] == list(plot_bounds):
+                known[name] = plot['checksum']
+    return known
+
+
+def restore_unchanged(previous, names, stats):
+    """Copy the saved statistics of every plot not marked changed into stats; returns stats['changed']."""
+    changed = stats['changed']
+    for i, name in enumerate(names):
+        if not changed[i]:
+            for stat, value in previous[name]['values'].items():
+                stats[stat][i] = value
+    return changed
+
+
+def save_plot_state(path, stat_names, names, bounds, checksums, stats):
+    """Save the checksum, boundary and statistics of every plot; stats is {stat name: array}."""
+    plots = {}
+    for i, name in enumerate(names):
+        plots[name] = {'bounds': list(bounds[i]),
+                       'checksum': checksums[i],
+                       'values': dict((s, stats[s][i].item()) for s in stat_names)}
+
+    tmp_path = path + '.%s.tmp' % os.getpid()
+    with open(tmp_path, 'w') as f:
+        json.dump({'stats': list(stat_names), 'plots': plots}, f)
+    os.rename(tmp_path, path)
+    return path
@@ -0,0 +1,89 @@
+'''
+Per-plot results for meantemp held as columns
+
+Results are collected as one numpy array per column and written out in bulk:
+BETY and Geostreams CSVs through the csv module, plus an optional NPZ or
+Parquet copy that keeps every statistics column.
+'''
+
+import os
+import csv
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+
+def open_csv(path):
+    # the csv module wants binary files on Python 2 and newline='' text files on Python 3
+    if sys.version_info[0] < 3:
+        return open(path, 'wb')
+    return open(path, 'w', newline='')
+
+
+class ResultTable(object):
+    """Equal-length named columns, one row per plot."""
+
+    def __init__(self, columns=None):
+        self.columns = OrderedDict()
+        for name, values in (columns or []):
+            self.add_column(name, values)
+
+    def __len__(self):
+        for values in self.columns.values():
+            return len(values)
+        return 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def add_column(self, name, values):
+        values = np.asarray(values)
+        if self.columns and len(values) != len(self):
+            raise ValueError("column %s has %s rows, table has %s" % (name, len(values), len(self)))
+        self.columns[name] = values
+
+    def select(self, rows):
+        """Return a new ResultTable with only rows (a boolean mask or index array)."""
+        return ResultTable([(name, values[rows]) for name, values in self.columns.items()])
+
+    def write_csv(self, path, fields, constants=None, aliases=None):
+        """Write the fields to path as a CSV with a header row.
+
+        Each field is taken from constants if it is there, otherwise from the column
+        named aliases.get(field, field).
+        """
+        constants = constants or {}
+        aliases = aliases or {}
+
+        values = []
+        for field in fields:
+            if field in constants:
+                values.append([constants[field]] * len(self))
+            else:
+                values.append(self.columns[aliases.get(field, field)].tolist())
+
+        with open_csv(path) as csvfile:
+            wr = csv.writer(csvfile, lineterminator='\n')
+            wr.writerow(fields)
+            wr.writerows(zip(*values))
+        return path
+
+    def save_npz(self, path):
+        np.savez_compressed(path, **self.columns)
+        return path
+
+    def save_parquet(self, path):
+        import pandas
+
+        pandas.DataFrame(OrderedDict(self.columns)).to_parquet(path)
+        return path
+
+    def save(self, path):
+        """Save every column to path; the format follows the extension (.npz or .parquet)."""
+        ext = os.path.splitext(path)[1]
+        if ext == '.npz':
+            return self.save_npz(path)
+        elif ext == '.parquet':
+            return self.save_parquet(path)
+        raise ValueError("unsupported table format %s" % ext)
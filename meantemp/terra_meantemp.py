@@ -2,45 +2,77 @@
 
 import os
 import numpy
-import json
-import yaml
+import argparse
+import multiprocessing
 
 from pyclowder.utils import CheckMessage
 from pyclowder.files import submit_extraction, download_metadata, upload_metadata
 from pyclowder.datasets import get_info
 from terrautils.extractors import TerrarefExtractor, is_latest_file, \
     build_dataset_hierarchy, build_metadata, load_json_file, upload_to_dataset, file_exists
-from terrautils.betydb import add_arguments, submit_traits, get_site_boundaries
+from terrautils.betydb import add_arguments, submit_traits
 from terrautils.metadata import get_extractor_metadata
-from terrautils.spatial import geojson_to_tuples_betydb, centroid_from_geojson, clip_raster
 
+from zonal_stats import plot_stats, StatsKernel, percentile_name
+from plot_index import get_plot_index
+from result_table import ResultTable
+from plot_state import load_plot_state, known_checksums, restore_unchanged, save_plot_state
+
+# per-plot statistics that can be reported as BETY traits; pN is the Nth percentile
+TRAIT_STATS = ('mean', 'std', 'variance', 'min', 'max')
+
+def parse_stats(value):
+    stats = []
+    for stat in [s.strip() for s in value.split(',') if s.strip()]:
+        if stat.startswith('p') and is_percentile(stat[1:]):
+            stat = percentile_name(float(stat[1:]))
+        elif stat not in TRAIT_STATS:
+            raise argparse.ArgumentTypeError("unknown statistic %s" % stat)
+        stats.append(stat)
+    return stats
+
+def is_percentile(value):
+    try:
+        return 0 <= float(value) <= 100
+    except ValueError:
+        return False
+
+def trait_name(stat):
+    return 'surface_temperature' if stat == 'mean' else 'surface_temperature_' + stat
 
 def add_local_arguments(parser):
     # add any additional arguments to parser
+    parser.add_argument('--plot-cache', dest="plot_cache", type=str, nargs='?', default="/home/extractor/plot_cache",
+                        help="directory where parsed plot boundaries are cached per date")
+    parser.add_argument('--read-mode', dest="read_mode", choices=['windowed', 'full'], default='windowed',
+                        help="read each plot's window, or the whole full-field image at once")
+    parser.add_argument('--no-sort-rows', dest="sort_rows", action='store_false',
+                        help="read plot windows in plot order instead of top-to-bottom raster order")
+    parser.add_argument('--gdal-cache', dest="gdal_cache", type=int, default=512,
+                        help="GDAL block cache size in MB shared by windowed plot reads")
+    parser.add_argument('--workers', dest="workers", type=int, default=multiprocessing.cpu_count(),
+                        help="processes that read plot windows in parallel (1 = serial)")
+    parser.add_argument('--table-format', dest="table_format", choices=['none', 'npz', 'parquet'], default='none',
+                        help="also save every per-plot statistic next to the CSVs in this format")
+    parser.add_argument('--stats', dest="stats", type=parse_stats, default=['mean'],
+                        help="comma-separated plot statistics submitted as traits (%s, or pN for the Nth percentile)" % ', '.join(TRAIT_STATS))
+    parser.add_argument('--incremental', dest="incremental", action='store_true',
+                        help="reprocess updated mosaics, recomputing and resubmitting only plots whose pixels or boundaries changed")
+
     add_arguments(parser)
 
-def get_traits_table():
-    # Compiled traits table
-    fields = ('local_datetime', 'surface_temperature', 'access_level', 'site', 'method')
+def get_traits_table(stats=('mean',)):
+    # Compiled traits table; stats selects which plot statistics become trait columns
+    fields = ('local_datetime',) + tuple(trait_name(s) for s in stats) + ('access_level', 'site', 'method')
     traits = {'local_datetime' : '',
-              'surface_temperature' : [],
               'access_level': '2',
               'site': [],
               'method': 'Mean temperature from infrared images'}
+    for stat in stats:
+        traits[trait_name(stat)] = []
 
     return (fields, traits)
 
-def generate_traits_list(traits):
-    # compose the summary traits
-    trait_list = [  traits['local_datetime'],
-                    traits['surface_temperature'],
-                    traits['access_level'],
-                    traits['site'],
-                    traits['method']
-                    ]
-
-    return trait_list
-
 def generate_csv(fname, fields, trait_list):
     """ Generate CSV called fname with fields and trait_list """
     csv = open(fname, 'w')
@@ -62,12 +94,22 @@ class FlirMeanTemp(TerrarefExtractor):
         # assign other argumentse
         self.bety_url = self.args.bety_url
         self.bety_key = self.args.bety_key
+        self.plot_cache = self.args.plot_cache
+        self.read_mode = self.args.read_mode
+        self.sort_rows = self.args.sort_rows
+        self.gdal_cache = self.args.gdal_cache
+        self.workers = self.args.workers
+        self.table_format = self.args.table_format
+        self.stats = self.args.stats
+        self.kernel = StatsKernel(percentiles=[float(s[1:]) for s in self.stats if s.startswith('p')])
+        self.incremental = self.args.incremental
 
     def check_message(self, connector, host, secret_key, resource, parameters):
         if resource['name'].startswith('ir_fullfield') and resource['name'].endswith(".tif"):
             # Check metadata to verify we have what we need
             md = download_metadata(connector, host, secret_key, resource['id'])
-            if get_extractor_metadata(md, self.extractor_info['name']) and not self.overwrite:
+            # In incremental mode a processed mosaic is reprocessed, but only its changed plots are recomputed
+            if get_extractor_metadata(md, self.extractor_info['name']) and not self.overwrite and not self.incremental:
                 self.log_skip(resource,"metadata indicates it was already processed")
                 return CheckMessage.ignore
             return CheckMessage.download
@@ -81,92 +123,113 @@ class FlirMeanTemp(TerrarefExtractor):
         # Get full list of experiment plots using date as filter
         ds_info = get_info(connector, host, secret_key, resource['parent']['id'])
         timestamp = ds_info['name'].split(" - ")[1]
-        time_fmt = timestamp+"T12:00:00-07:00"
         rootdir = self.sensors.create_sensor_path(timestamp, sensor="ir_meantemp", ext=".csv")
         out_csv = os.path.join(os.path.dirname(rootdir),
                                resource['name'].replace(".tif", "_meantemp_bety.csv"))
         out_geo = os.path.join(os.path.dirname(rootdir),
                                resource['name'].replace(".tif", "_meantemp_geo.csv"))
 
-        self.log_info(resource, "Writing BETY CSV to %s" % out_csv)
-        csv_file = open(out_csv, 'w')
-        (fields, traits) = get_traits_table()
-        csv_file.write(','.join(map(str, fields)) + '\n')
+        all_plots = get_plot_index(timestamp, 'Maricopa', self.plot_cache, exclude=["KSU"])
 
-        self.log_info(resource, "Writing Geostreams CSV to %s" % out_geo)
-        geo_file = open(out_geo, 'w')
-        geo_file.write(','.join(['site', 'trait', 'lat', 'lon', 'dp_time', 'source', 'value', 'timestamp']) + '\n')
-
-        successful_plots = 0
-        nan_plots = 0
-        all_plots = get_site_boundaries(timestamp, city='Maricopa')
-        for plotname in all_plots:
-            if plotname.find("KSU") > -1:
-                self.log_info(resource, "skipping %s" % plotname)
-                continue
-
-            bounds = all_plots[plotname]
-            tuples = geojson_to_tuples_betydb(yaml.safe_load(bounds))
-            centroid_lonlat = json.loads(centroid_from_geojson(bounds))["coordinates"]
-
-            # Use GeoJSON string to clip full field to this plot
-            pxarray = clip_raster(resource['local_paths'][0], tuples, "/home/extractor/temp.tif")
-            os.remove("/home/extractor/temp.tif")
-
-            # Filter out any
-            pxarray[pxarray < 0] = numpy.nan
-            mean_tc = numpy.nanmean(pxarray) - 273.15
-
-            # Create BETY-ready CSV
-            if not numpy.isnan(mean_tc):
-                geo_file.write(','.join([plotname,
-                                         'IR Surface Temperature',
-                                         str(centroid_lonlat[1]),
-                                         str(centroid_lonlat[0]),
-                                         time_fmt,
-                                         host + ("" if host.endswith("/") else "/") + "files/" + resource['id'],
-                                         str(mean_tc),
-                                         timestamp]) + '\n')
-
-                traits['surface_temperature'] = str(mean_tc)
-                traits['site'] = plotname
-                traits['local_datetime'] = timestamp+"T12:00:00"
-                trait_list = generate_traits_list(traits)
-                csv_file.write(','.join(map(str, trait_list)) + '\n')
-            else:
-                nan_plots += 1
-
-            successful_plots += 1
+        # Checksums of the plots from the last run on this mosaic, if running incrementally
+        state_file = out_csv.replace("_bety.csv", "_plots.json")
+        previous = load_plot_state(state_file, self.kernel.names()) if self.incremental else None
+        known = known_checksums(previous, all_plots.names, all_plots.bounds.tolist()) if self.incremental else None
+
+        # Open the full field once and aggregate every plot that overlaps it
+        plots, stats = plot_stats(resource['local_paths'][0], all_plots, self.kernel,
+                                  windowed=(self.read_mode == 'windowed'),
+                                  sort_rows=self.sort_rows, cache_mb=self.gdal_cache,
+                                  workers=self.workers, known=known)
+        self.log_info(resource, "computed zonal statistics for %s of %s plots overlapping the image" % (len(plots), len(all_plots)))
 
+        plot_names = all_plots.names[plots]
+        if known is not None:
+            changed = restore_unchanged(previous, plot_names, stats)
+            self.log_info(resource, "%s of %s plots changed since the last run" % (numpy.count_nonzero(changed), len(plots)))
+        else:
+            changed = numpy.ones(len(plots), dtype=bool)
+
+        results = ResultTable([('site', plot_names),
+                               ('lat', all_plots.centroids[plots, 1]),
+                               ('lon', all_plots.centroids[plots, 0]),
+                               ('valid_pixels', stats['valid_count']),
+                               ('total_pixels', stats['pixel_count'])])
+        for stat in self.kernel.names():
+            if not stat.endswith('_count'):
+                # variance is the same in K and C; the other statistics are temperatures
+                results.add_column(trait_name(stat), stats[stat] if stat == 'variance' else stats[stat] - 273.15)
+        results.add_column(trait_name('std'), numpy.sqrt(stats['variance']))
+        successful_plots = len(results)
+        valid = ~numpy.isnan(results['surface_temperature'])
+        nan_plots = successful_plots - numpy.count_nonzero(valid)
         self.log_info(resource, "skipped %s of %s plots due to NaN" % (nan_plots, len(all_plots)))
 
-        # submit CSV to BETY
-        csv_file.close()
-        geo_file.close()
+        self.write_csvs(results.select(valid), out_csv, out_geo, timestamp, host, resource)
+
+        if self.table_format != 'none':
+            out_table = out_csv.replace("_bety.csv", "_plots." + self.table_format)
+            self.log_info(resource, "Writing per-plot table to %s" % out_table)
+            results.save(out_table)
+
+        # On an incremental rerun only the changed plots are uploaded and submitted
+        if previous is not None:
+            out_csv = out_csv.replace("_bety.csv", "_bety_changed.csv")
+            out_geo = out_geo.replace("_geo.csv", "_geo_changed.csv")
+            self.write_csvs(results.select(valid & changed), out_csv, out_geo, timestamp, host, resource)
+        submit = numpy.count_nonzero(valid & changed) > 0
 
         # Upload CSVs to Clowder
-        fileid = upload_to_dataset(connector, host, self.clowder_user, self.clowder_pass, resource['parent']['id'], out_csv)
-        geoid  = upload_to_dataset(connector, host, self.clowder_user, self.clowder_pass, resource['parent']['id'], out_geo)
+        files_created = []
+        if submit:
+            fileid = upload_to_dataset(connector, host, self.clowder_user, self.clowder_pass, resource['parent']['id'], out_csv)
+            geoid  = upload_to_dataset(connector, host, self.clowder_user, self.clowder_pass, resource['parent']['id'], out_geo)
+            files_created = [fileid, geoid]
 
         # Tell Clowder this is completed so subsequent file updates don't daisy-chain
         self.log_info(resource, "updating file metadata")
         metadata = build_metadata(host, self.extractor_info, resource['parent']['id'], {
             "total_plots": len(all_plots),
             "plots_processed": successful_plots,
+            "plots_changed": int(numpy.count_nonzero(changed)),
             "blank_plots": nan_plots,
-            "files_created": [fileid, geoid],
+            "files_created": files_created,
             "betydb_link": "https://terraref.ncsa.illinois.edu/bety/api/beta/variables?name=surface_temperature"
         }, 'dataset')
         upload_metadata(connector, host, secret_key, resource['id'], metadata)
 
         # Trigger downstream extractors
-        self.log_info(resource, "triggering BETY extractor on %s" % fileid)
-        submit_extraction(connector, host, secret_key, fileid, "terra.betydb")
-        self.log_info(resource, "triggering geostreams extractor on %s" % geoid)
-        submit_extraction(connector, host, secret_key, geoid, "terra.geostreams")
+        if submit:
+            self.log_info(resource, "triggering BETY extractor on %s" % fileid)
+            submit_extraction(connector, host, secret_key, fileid, "terra.betydb")
+            self.log_info(resource, "triggering geostreams extractor on %s" % geoid)
+            submit_extraction(connector, host, secret_key, geoid, "terra.geostreams")
+        else:
+            self.log_skip(resource, "no changed plots to submit")
+
+        # Only record the plots as done once their values are uploaded and submitted
+        if known is not None:
+            save_plot_state(state_file, self.kernel.names(), plot_names, all_plots.bounds[plots].tolist(),
+                            stats['checksum'], stats)
 
         self.end_message(resource)
 
+    def write_csvs(self, results, out_csv, out_geo, timestamp, host, resource):
+        """Write the BETY and Geostreams CSVs for the plots in results."""
+        self.log_info(resource, "Writing BETY CSV to %s" % out_csv)
+        (fields, traits) = get_traits_table(self.stats)
+        traits['local_datetime'] = timestamp+"T12:00:00"
+        results.write_csv(out_csv, fields,
+                          constants=dict((k, v) for k, v in traits.items() if not isinstance(v, list)))
+
+        self.log_info(resource, "Writing Geostreams CSV to %s" % out_geo)
+        results.write_csv(out_geo, ['site', 'trait', 'lat', 'lon', 'dp_time', 'source', 'value', 'timestamp'],
+                          constants={'trait': 'IR Surface Temperature',
+                                     'dp_time': timestamp+"T12:00:00-07:00",
+                                     'source': host + ("" if host.endswith("/") else "/") + "files/" + resource['id'],
+                                     'timestamp': timestamp},
+                          aliases={'value': 'surface_temperature'})
+
 if __name__ == "__main__":
     extractor = FlirMeanTemp()
     extractor.start()
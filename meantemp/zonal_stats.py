@@ -0,0 +1,288 @@
+'''
+Per-plot zonal statistics over a full-field GeoTIFF
+
+The mosaic is opened once and plots are aggregated without temporary clip files,
+either by reading each plot's pixel window (block-aligned, through GDAL's block
+cache) or by reading the whole raster once and slicing every window from it.
+Each window goes through StatsKernel once for all the per-plot statistics.
+'''
+
+import math
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+def bounds_to_window(geotransform, bounds, raster_xsize, raster_ysize):
+    """Convert (lat min, lat max, long min, long max) to a pixel window (xoff, yoff, xsize, ysize).
+
+    Offsets are rounded like gdal_translate -projwin so the window covers the same
+    pixels terrautils.spatial.clip_raster used to read. Returns None if the plot
+    does not overlap the raster.
+    """
+    min_y, max_y, min_x, max_x = bounds
+    ulx = (min_x - geotransform[0]) / geotransform[1]
+    uly = (max_y - geotransform[3]) / geotransform[5]
+    lrx = (max_x - geotransform[0]) / geotransform[1]
+    lry = (min_y - geotransform[3]) / geotransform[5]
+
+    xoff = int(math.floor(ulx + 0.001))
+    yoff = int(math.floor(uly + 0.001))
+    xend = xoff + int(math.floor(lrx - ulx + 0.5))
+    yend = yoff + int(math.floor(lry - uly + 0.5))
+
+    # clip to the raster
+    xoff, yoff = max(xoff, 0), max(yoff, 0)
+    xend, yend = min(xend, raster_xsize), min(yend, raster_ysize)
+    if xend <= xoff or yend <= yoff:
+        return None
+    return (xoff, yoff, xend - xoff, yend - yoff)
+
+
+def raster_extent(geotransform, raster_xsize, raster_ysize):
+    """Return the raster footprint as (lat min, lat max, long min, long max)."""
+    x0, x1 = geotransform[0], geotransform[0] + raster_xsize*geotransform[1]
+    y0, y1 = geotransform[3], geotransform[3] + raster_ysize*geotransform[5]
+    return (min(y0, y1), max(y0, y1), min(x0, x1), max(x0, x1))
+
+
+class StatsKernel(object):
+    """Per-plot count, valid count, mean, variance, min, max and percentiles.
+
+    Negative and NaN pixels are not valid. Percentiles come from a histogram with
+    fixed bins over hist_range, so they are exact to within bin_width; valid pixels
+    outside hist_range fall in the first or last bin.
+    """
+
+    def __init__(self, percentiles=(), hist_range=(223.15, 373.15), bin_width=0.01):
+        self.percentiles = tuple(percentiles)
+        self.hist_range = hist_range
+        self.bin_width = float(bin_width)
+        self.nbins = int(math.ceil((hist_range[1] - hist_range[0]) / self.bin_width))
+
+    def names(self):
+        return ['pixel_count', 'valid_count', 'mean', 'variance', 'min', 'max'] + \
+               [percentile_name(q) for q in self.percentiles]
+
+    def empty(self, nplots):
+        """Return an OrderedDict of stat name -> array for nplots plots, NaN until computed."""
+        stats = OrderedDict()
+        for name in self.names():
+            if name.endswith('_count'):
+                stats[name] = np.zeros(nplots, dtype='int64')
+            else:
+                stats[name] = np.full(nplots, np.nan)
+        return stats
+
+    def compute(self, values, stats, i):
+        """Fill row i of stats from one plot window."""
+        stats['pixel_count'][i] = values.size
+        with np.errstate(invalid='ignore'):
+            valid = values[values >= 0]
+        n = valid.size
+        stats['valid_count'][i] = n
+        if n == 0:
+            return
+
+        total = valid.sum(dtype='float64')
+        mean = total / n
+        stats['mean'][i] = mean
+        stats['variance'][i] = max(np.einsum('i,i->', valid, valid, dtype='float64') / n - mean*mean, 0.0)
+        stats['min'][i] = valid.min()
+        stats['max'][i] = valid.max()
+
+        if self.percentiles:
+            for q, value in zip(self.percentiles, self.histogram_percentiles(valid)):
+                stats[percentile_name(q)][i] = min(max(value, stats['min'][i]), stats['max'][i])
+
+    def histogram_percentiles(self, valid):
+        bins = np.floor((valid - self.hist_range[0]) / self.bin_width)
+        np.clip(bins, 0, self.nbins - 1, out=bins)
+        counts = np.bincount(bins.astype('intp'), minlength=self.nbins)
+        cdf = np.cumsum(counts)
+
+        values = []
+        for q in self.percentiles:
+            rank = q / 100.0 * valid.size
+            b = min(int(np.searchsorted(cdf, rank, side='left')), self.nbins - 1)
+            below = cdf[b] - counts[b]
+            frac = (rank - below) / counts[b] if counts[b] else 0.0
+            values.append(self.hist_range[0] + (b + frac) * self.bin_width)
+        return values
+
+
+def percentile_name(q):
+    return 'p%g' % q
+
+
+def block_aligned(window, block_xsize, block_ysize, raster_xsize, raster_ysize):
+    """Grow a pixel window to the raster blocks it touches."""
+    xoff, yoff, xsize, ysize = window
+    axoff = (xoff // block_xsize) * block_xsize
+    ayoff = (yoff // block_ysize) * block_ysize
+    axend = min(-(-(xoff + xsize) // block_xsize) * block_xsize, raster_xsize)
+    ayend = min(-(-(yoff + ysize) // block_ysize) * block_ysize, raster_ysize)
+    return (axoff, ayoff, axend - axoff, ayend - ayoff)
+
+
+def read_windows(band, windows, sort_rows=True):
+    """Yield (i, pixels) for every non-empty window, reading block-aligned windows from band.
+
+    With sort_rows, windows are visited top to bottom so consecutive plots reuse
+    the blocks already in GDAL's block cache and the file is read sequentially.
+    """
+    block_xsize, block_ysize = band.GetBlockSize()
+    order = [i for i in range(len(windows)) if windows[i] is not None]
+    if sort_rows:
+        order.sort(key=lambda i: (windows[i][1], windows[i][0]))
+
+    for i in order:
+        xoff, yoff, xsize, ysize = windows[i]
+        axoff, ayoff, axsize, aysize = block_aligned(windows[i], block_xsize, block_ysize,
+                                                     band.XSize, band.YSize)
+        pixels = band.ReadAsArray(axoff, ayoff, axsize, aysize)
+        yield i, pixels[yoff-ayoff:yoff-ayoff+ysize, xoff-axoff:xoff-axoff+xsize]
+
+
+def window_checksum(window, pixels):
+    """SHA-1 of a plot window's position, pixel type and pixel bytes."""
+    digest = hashlib.sha1(repr((tuple(window), str(pixels.dtype))).encode('utf-8'))
+    digest.update(np.ascontiguousarray(pixels).tobytes())
+    return digest.hexdigest()
+
+
+def empty_stats(kernel, nplots, known=None):
+    """kernel.empty(nplots), plus 'checksum' and 'changed' columns when known checksums are given."""
+    stats = kernel.empty(nplots)
+    if known is not None:
+        stats['checksum'] = np.zeros(nplots, dtype='U40')
+        stats['changed'] = np.ones(nplots, dtype=bool)
+    return stats
+
+
+def compute_window(kernel, stats, i, window, pixels, known=None):
+    """Run kernel on window i, unless its checksum matches known[i] (then only 'changed' is cleared)."""
+    if known is not None:
+        checksum = window_checksum(window, pixels)
+        stats['checksum'][i] = checksum
+        if checksum == known[i]:
+            stats['changed'][i] = False
+            return
+    kernel.compute(pixels, stats, i)
+
+
+def window_stats(band, windows, kernel, sort_rows=True, known=None):
+    """Return kernel's statistics for every window of band, as an OrderedDict of arrays.
+
+    known is an optional list of checksums from a previous run, one per window
+    (None if unknown); windows whose pixels still match are not recomputed.
+    """
+    stats = empty_stats(kernel, len(windows), known)
+    for i, pixels in read_windows(band, windows, sort_rows):
+        compute_window(kernel, stats, i, windows[i], pixels, known)
+    return stats
+
+
+def open_shared(raster_path, cache_mb=None):
+    """Open raster_path read-only, memory-mapping uncompressed GeoTIFFs so processes share pages."""
+    from osgeo import gdal
+
+    gdal.SetConfigOption('GTIFF_VIRTUAL_MEM_IO', 'IF_ENOUGH_RAM')
+    if cache_mb:
+        gdal.SetCacheMax(int(cache_mb) * 1024 * 1024)
+    return gdal.Open(raster_path, gdal.GA_ReadOnly)
+
+
+def window_stats_task(task):
+    """Pool worker: (raster_path, start, windows, kernel, sort_rows, cache_mb, known) -> (start, window_stats)."""
+    raster_path, start, windows, kernel, sort_rows, cache_mb, known = task
+    ds = open_shared(raster_path, cache_mb)
+    result = window_stats(ds.GetRasterBand(1), windows, kernel, sort_rows, known)
+    ds = None
+    return start, result
+
+
+def parallel_window_stats(raster_path, windows, kernel, workers, sort_rows=True, cache_mb=None, known=None):
+    """window_stats over contiguous plot ranges in a process pool; results stay in window order.
+
+    Every worker opens its own read-only handle on the raster, so nothing is written
+    to a shared scratch file. With sort_rows the windows are split in row order,
+    so each worker reads its own horizontal band of the image.
+    """
+    from multiprocessing import Pool
+
+    order = np.arange(len(windows))
+    if sort_rows:
+        rows = [w[1] if w is not None else -1 for w in windows]
+        order = np.argsort(rows, kind='mergesort')
+    ranges = [r for r in np.array_split(order, workers) if len(r)]
+    # per-worker share of the block cache
+    worker_cache = int(cache_mb) // len(ranges) if cache_mb else None
+
+    stats = empty_stats(kernel, len(windows), known)
+
+    tasks = [(raster_path, n, [windows[i] for i in r], kernel, sort_rows, worker_cache,
+              [known[i] for i in r] if known is not None else None)
+             for n, r in enumerate(ranges)]
+    pool = Pool(len(ranges))
+    try:
+        for n, result in pool.imap_unordered(window_stats_task, tasks):
+            for name, values in result.items():
+                stats[name][ranges[n]] = values
+    finally:
+        pool.close()
+        pool.join()
+
+    return stats
+
+
+def plot_stats(raster_path, plot_index, kernel=None, windowed=True, sort_rows=True, cache_mb=None, workers=1,
+               known=None):
+    """Statistics per plot of a PlotIndex, for the plots that overlap the raster.
+
+    windowed reads only each plot's window (the default, for multi-GB mosaics);
+    otherwise the whole band is read once and the windows are sliced from it.
+    cache_mb sets GDAL's block cache size for windowed reads. workers > 1 splits
+    the windowed reads across that many processes. kernel defaults to a
+    StatsKernel without percentiles.
+
+    known is an optional {plot name: checksum} from a previous run. When given, the
+    result also has 'checksum' and 'changed' columns, and plots whose window
+    checksum is unchanged are not recomputed (their statistics are left NaN/0).
+
+    Returns (plot indices, OrderedDict of stat name -> array); plots are in index order.
+    """
+    kernel = kernel or StatsKernel()
+
+    ds = open_shared(raster_path, cache_mb)
+    geotransform = ds.GetGeoTransform()
+    xsize, ysize = ds.RasterXSize, ds.RasterYSize
+
+    plots = plot_index.query(raster_extent(geotransform, xsize, ysize))
+    plot_bounds = plot_index.bounds[plots]
+
+    windows = [bounds_to_window(geotransform, b, xsize, ysize) for b in plot_bounds]
+    band = ds.GetRasterBand(1)
+    if known is not None:
+        known = [known.get(name) for name in plot_index.names[plots]]
+
+    if windowed and workers > 1 and len(windows) > 1:
+        band = None
+        ds = None
+        stats = parallel_window_stats(raster_path, windows, kernel, min(workers, len(windows)),
+                                      sort_rows, cache_mb, known)
+    elif windowed:
+        stats = window_stats(band, windows, kernel, sort_rows, known)
+    else:
+        values = band.ReadAsArray()
+        stats = empty_stats(kernel, len(windows), known)
+        for i, window in enumerate(windows):
+            if window is not None:
+                xoff, yoff, wxsize, wysize = window
+                compute_window(kernel, stats, i, window, values[yoff:yoff+wysize, xoff:xoff+wxsize], known)
+
+    band = None
+    ds = None
+
+    return plots, stats
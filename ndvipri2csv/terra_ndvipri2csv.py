@@ -12,8 +12,9 @@ from pyclowder.utils import CheckMessage
 from pyclowder.datasets import download_metadata, get_info, upload_metadata
 from pyclowder.files import upload_to_dataset
 from terrautils.metadata import get_extractor_metadata
-from terrautils.extractors import TerrarefExtractor, is_latest_file, build_dataset_hierarchy, \
-    build_metadata
+from terrautils.extractors import TerrarefExtractor, is_latest_file, build_metadata
+
+from hierarchy_cache import resolve_dataset, invalidate_on_404
 
 
 class BinValues2Csv(TerrarefExtractor):
@@ -55,9 +56,9 @@ class BinValues2Csv(TerrarefExtractor):
         out_file = self.create_sensor_path(timestamp, opts=['extracted_values'])
         uploaded_file_ids = []
 
-        target_dsid = build_dataset_hierarchy(connector, host, secret_key, self.clowderspace,
-                                              self.sensors.get_display_name(), timestamp[:4], timestamp[:7],
-                                              timestamp[:10], leaf_ds_name=resource['dataset_info']['name'])
+        target_dsid = resolve_dataset(host, secret_key, self.clowder_user, self.clowder_pass, self.clowderspace,
+                                      None, None, self.sensors.get_display_name(), timestamp[:10],
+                                      resource['dataset_info']['name'])
 
         # Extract NDVI values
         if not os.path.isfile(out_file) or self.overwrite:
@@ -73,7 +74,8 @@ class BinValues2Csv(TerrarefExtractor):
 
             # TODO: Send this to geostreams
 
-            fileid = upload_to_dataset(connector, host, secret_key, target_dsid, out_file)
+            with invalidate_on_404(target_dsid):
+                fileid = upload_to_dataset(connector, host, secret_key, target_dsid, out_file)
             uploaded_file_ids.append(fileid)
 
             self.created += 1
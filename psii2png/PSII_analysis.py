@@ -8,7 +8,6 @@ Created on Jan 12, 2017
 import os, sys, json
 import numpy as np
 from PIL import Image
-from matplotlib import pyplot as plt
 
 
 
@@ -75,6 +74,7 @@ def load_PSII_png(file_path, height, width):
         fail('Error loading image "%s": %s' % (file_path,str(ex)))
         
 def psii_analysis(frames, hist_path, coloredImg_path):
+    from psii_render import render_pseudocolor, fixed_histogram, render_histogram_chart
     
     img_width = 1936
     img_height = 1216
@@ -101,25 +101,12 @@ def psii_analysis(frames, hist_path, coloredImg_path):
     fvfm[np.where(np.isinf(fvfm))] = 0
     fvfm[np.where(fvfm > 1.0)] = 0
     
-    fig, ax = plt.subplots()
-    
-    # Plot Fv/Fm (pseudocolored)
-    plt.imshow(fvfm, cmap="viridis")
-    plt.show()
-    plt.savefig(coloredImg_path)
-    plt.close()
-    
-    # Calculate histogram of Fv/Fm values from the whole image
-    hist, bins = np.histogram(fvfm, bins=20)
-    # Plot Fv/Fm histogram
-    width = 0.7 * (bins[1] - bins[0])
-    center = (bins[:-1] + bins[1:]) / 2
-    plt.bar(center, hist, align='center', width=width)
-    plt.xlabel("Fv/Fm")
-    plt.ylabel("Pixels")
-    plt.show()
-    plt.savefig(hist_path)
-    plt.close()
+    # Fv/Fm (pseudocolored) at sensor resolution
+    render_pseudocolor(fvfm, coloredImg_path)
+    
+    # Histogram of Fv/Fm values from the whole image over 20 fixed bins in [0, 1]
+    hist, bins = fixed_histogram(fvfm, bins=20)
+    render_histogram_chart(hist, bins, hist_path)
     
     return
 
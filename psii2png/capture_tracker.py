@@ -0,0 +1,137 @@
+'''
+Coalescing of the file.added events of a PSII capture
+
+Every PSII dataset receives a file.added message for each of its ~102 files. The
+tracker indexes a dataset's file names by frame suffix in one pass and remembers
+which captures have already been dispatched, so check_message only does real work
+for the event that completes a capture.
+
+Configuration (environment):
+    CAPTURE_TRACKER_TTL  -- seconds a dispatched capture is remembered (default 86400)
+    CAPTURE_TRACKER_FILE -- optional JSON file to persist processed captures across restarts;
+                            extractors may share it
+
+psii2png and psii_fluorescence each have a copy of this file;
+tests/test_shared_modules.py checks that the copies are identical.
+'''
+
+import os
+import json
+import time
+import logging
+
+# *0000.bin .. *0100.bin are frames, *0101.bin lists the frame times
+CAPTURE_FILES = 102
+DEFAULT_TTL = 86400
+
+
+def frame_index(filename):
+    """Return the frame number of a *NNNN.bin file name, or None."""
+    if filename.endswith('.bin') and filename[-8:-4].isdigit():
+        return int(filename[-8:-4])
+    return None
+
+
+def index_frames(files):
+    """Return {frame number: file name} for a list of Clowder file records."""
+    frames = {}
+    for f in files:
+        ind = frame_index(f['filename'])
+        if ind is not None:
+            frames[ind] = f['filename']
+    return frames
+
+
+def is_complete(frames, count=CAPTURE_FILES):
+    return all(ind in frames for ind in range(count))
+
+
+class CaptureTracker(object):
+    """Remember which datasets have had their complete capture dispatched, with TTL eviction.
+
+    A capture is claimed when it is dispatched and completed once it has been
+    processed. Claims in flight are kept in memory only, so a crash mid-capture
+    leaves nothing behind and the redelivered message is processed again; only
+    completed captures are persisted to state_file. Keys are prefixed with
+    namespace (the extractor name), so extractors can share one state_file.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, state_file=None, namespace=None):
+        self.ttl = ttl
+        self.state_file = state_file
+        self.prefix = namespace + ':' if namespace else ''
+        self.claims = {}
+        self.in_flight = {}
+        if state_file:
+            self.load()
+
+    def key(self, dataset_id):
+        return self.prefix + dataset_id
+
+    def claimed(self, dataset_id):
+        key = self.key(dataset_id)
+        now = time.time()
+        for claims in (self.in_flight, self.claims):
+            expires = claims.get(key)
+            if expires is not None:
+                if expires >= now:
+                    return True
+                del claims[key]
+        return False
+
+    def claim(self, dataset_id):
+        """Record that the capture of dataset_id was dispatched; later events for it can be ignored."""
+        self.in_flight[self.key(dataset_id)] = time.time() + self.ttl
+
+    def complete(self, dataset_id):
+        """Record that the capture of dataset_id was processed, persisting the claim."""
+        key = self.key(dataset_id)
+        self.in_flight.pop(key, None)
+        self.claims[key] = time.time() + self.ttl
+        if self.state_file:
+            self.save()
+
+    def release(self, dataset_id):
+        key = self.key(dataset_id)
+        self.in_flight.pop(key, None)
+        if self.claims.pop(key, None) is not None and self.state_file:
+            self.save()
+
+    def read_state(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            # missing or unreadable state just means every capture is checked again
+            return {}
+
+    def load(self):
+        now = time.time()
+        for key, expires in self.read_state().items():
+            if key.startswith(self.prefix) and expires >= now:
+                self.claims[key] = expires
+
+    def save(self):
+        now = time.time()
+        self.claims = dict((k, v) for k, v in self.claims.items() if v >= now)
+        # keep the claims of other extractors sharing the file
+        state = dict((k, v) for k, v in self.read_state().items() if not k.startswith(self.prefix) and v >= now)
+        state.update(self.claims)
+        tmp_file = self.state_file + '.%s.tmp' % os.getpid()
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp_file, self.state_file)
+        except (IOError, OSError) as ex:
+            logging.getLogger(__name__).warning("could not write capture tracker %s: %s" % (self.state_file, str(ex)))
+
+
+# CaptureTracker per extractor name
+_trackers = {}
+
+def get_tracker(namespace):
+    """Return the process-wide CaptureTracker of an extractor, configured from the environment on first use."""
+    if namespace not in _trackers:
+        _trackers[namespace] = CaptureTracker(int(os.environ.get('CAPTURE_TRACKER_TTL', DEFAULT_TTL)),
+                                              os.environ.get('CAPTURE_TRACKER_FILE') or None, namespace)
+    return _trackers[namespace]
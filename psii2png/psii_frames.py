@@ -0,0 +1,188 @@
+'''
+PSII capture frames
+
+A PSII capture is 101 raw uint8 frames (*0000.bin .. *0100.bin) plus a frame-time
+file (*0101.bin). Frame 0 is the dark frame (F0), frame 1 the first illuminated
+frame (Fmin), and F-max is the frame with the highest maximum among the rest.
+
+The frames are not stacked into a (frames, height, width) cube. They are read
+one at a time, and FrameStats / FmaxScanner keep F0, Fmin and the F-max
+candidates while the per-frame aggregates are collected. At most a few frames
+are resident, and reading stops early once F-max has settled.
+
+psii2png and psii_fluorescence each have a copy of this file;
+tests/test_shared_modules.py checks that the copies are identical.
+'''
+
+import numpy as np
+
+
+def get_image_dimensions(metadata):
+    """Returns (image width, image height)"""
+
+    if 'sensor_fixed_metadata' in metadata:
+        dims = metadata['sensor_fixed_metadata']['camera_resolution']
+        return dims.split("x")
+    else:
+        # Default based on original fixed metadata
+        return (1936, 1216)
+
+
+def read_frame(path, width, height):
+    """Read one raw PSII frame into a (height, width) uint8 array."""
+    return np.fromfile(path, np.dtype('uint8')).reshape([int(height), int(width)])
+
+
+class FmaxScanner(object):
+    """Track the k frames with the highest key while frames are streamed in order.
+
+    Only the top k frames stay resident. With a window, the scan is finished once
+    the saturating pulse has been seen, i.e. a frame's intensity level exceeded
+    rise times the pre-pulse baseline given to add_baseline(), and window frames
+    have gone by since then without the top k changing. A flat or falling stretch
+    before the pulse never ends the scan.
+    """
+
+    def __init__(self, k=1, window=None, rise=1.5):
+        self.k = k
+        self.window = window
+        self.rise = rise
+        self.top = []  # (key, frame index, pixels), highest key first
+        self.baseline = None
+        self.armed = False
+        self.last_change = None
+        self.last_index = None
+
+    def add_baseline(self, level):
+        """Include the level of a frame before the pulse (e.g. F0 or Fmin) in the baseline."""
+        level = float(level)
+        self.baseline = level if self.baseline is None else max(self.baseline, level)
+
+    def add(self, ind, pixels, key, level=None):
+        """Offer frame ind with its ranking key; returns False once the scan can stop.
+
+        level is the frame's intensity level, on the scale of the baseline; it
+        defaults to the first element of key.
+        """
+        level = key[0] if level is None else level
+        self.last_index = ind
+        if len(self.top) < self.k or key > self.top[-1][0]:
+            self.top.append((key, ind, pixels))
+            self.top.sort(key=lambda entry: entry[0], reverse=True)
+            del self.top[self.k:]
+            self.last_change = ind
+        if not self.armed and self.baseline is not None and float(level) > self.rise * self.baseline:
+            # the pulse has started; the window counts from here
+            self.armed = True
+            self.last_change = ind
+        return not self.finished()
+
+    def finished(self):
+        return self.window is not None and self.armed and len(self.top) == self.k and \
+            self.last_index - self.last_change >= self.window
+
+    def best(self, rank=0):
+        """Return (frame index, pixels) of the frame ranked rank (0 = highest), or (None, None)."""
+        if rank >= len(self.top):
+            return None, None
+        return self.top[rank][1], self.top[rank][2]
+
+
+class FrameStats(object):
+    """Per-frame max, mean and nonzero mean of a capture, collected as each frame is read.
+
+    Only F0, Fmin and the current F-max candidate stay resident. With fmax_window,
+    finished() turns true once the frame mean has risen above that of F0 and Fmin
+    and F-max has then held for fmax_window frames, so the remaining frames need
+    not be read for the aggregates. The pulse is detected on the mean rather than
+    the maximum, which a few saturated pixels in F0 or Fmin would put out of reach.
+    """
+
+    def __init__(self, nframes=101, fmax_window=None):
+        self.nframes = nframes
+        self.seen = np.zeros(nframes, dtype=bool)
+        self.max = np.zeros(nframes, dtype='uint8')
+        self.mean = np.zeros(nframes)
+        self.nonzero_mean = np.zeros(nframes)
+
+        self.f0 = None
+        self.fmin = None
+        self.scanner = FmaxScanner(k=1, window=fmax_window)
+
+    @property
+    def fmax_index(self):
+        return self.scanner.best()[0]
+
+    @property
+    def fmax(self):
+        return self.scanner.best()[1]
+
+    def add(self, ind, pixels):
+        total = pixels.sum(dtype='uint64')
+        nonzero = np.count_nonzero(pixels)
+
+        self.seen[ind] = True
+        self.max[ind] = pixels.max()
+        self.mean[ind] = float(total) / pixels.size
+        self.nonzero_mean[ind] = float(total) / nonzero if nonzero else 0.0
+
+        if ind == 0:
+            self.f0 = pixels
+        elif ind == 1:
+            self.fmin = pixels
+        if ind in (0, 1):
+            self.scanner.add_baseline(self.mean[ind])
+
+        # Fmin is not an F-max candidate; the first frame with the highest maximum wins
+        if ind != 1:
+            self.scanner.add(ind, pixels, (self.max[ind], -ind), self.mean[ind])
+
+    def finished(self):
+        """True once F0, Fmin and F-max are settled (every frame seen, or the F-max window passed)."""
+        return self.complete() or (self.f0 is not None and self.fmin is not None and self.scanner.finished())
+
+    def complete(self):
+        return bool(self.seen.all())
+
+
+def fvfm_kernel(fmax, fmin, out=None, valid=None):
+    """Fv/Fm = (F-max - F-min) / F-max in float32, with its validity mask and summary stats.
+
+    A pixel is valid where F-max > 0 and F-min <= F-max; invalid pixels are 0, as
+    when the old uint8 computation wrapped or divided by zero. out (float32) and
+    valid (bool) may be passed in to reuse buffers across captures.
+
+    Returns (fvfm, valid, {'valid_count', 'mean', 'std', 'min', 'max'}); the
+    statistics cover valid pixels only and are NaN if there are none.
+    """
+    if out is None:
+        out = np.empty(fmax.shape, dtype='float32')
+    if valid is None:
+        valid = np.empty(fmax.shape, dtype=bool)
+
+    np.less_equal(fmin, fmax, out=valid)
+    np.logical_and(valid, fmax, out=valid)
+
+    # Invalid pixels hold 1.0 (>= any valid ratio) until the minimum is taken
+    out.fill(1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.subtract(fmax, fmin, out=out, where=valid, dtype='float32')
+        np.divide(out, fmax, out=out, where=valid, dtype='float32')
+
+    valid_count = int(np.count_nonzero(valid))
+    stats = {'valid_count': valid_count, 'mean': np.nan, 'std': np.nan, 'min': np.nan, 'max': np.nan}
+    if valid_count:
+        stats['min'] = float(out.min())
+
+    np.logical_not(valid, out=valid)
+    np.copyto(out, 0, where=valid)
+    np.logical_not(valid, out=valid)
+
+    if valid_count:
+        flat = out.reshape(-1)
+        mean = flat.sum(dtype='float64') / valid_count
+        stats['mean'] = mean
+        stats['std'] = max(np.einsum('i,i->', flat, flat, dtype='float64') / valid_count - mean*mean, 0.0) ** 0.5
+        stats['max'] = float(out.max())
+
+    return out, valid, stats
@@ -0,0 +1,89 @@
+'''
+Headless rendering of PSII Fv/Fm outputs
+
+The pseudocoloured map is written at sensor resolution by looking every pixel up
+in a precomputed viridis table and saving the RGB array with PIL. The Fv/Fm
+histogram is counted over fixed bins; matplotlib is only imported to draw the
+optional histogram chart, without pyplot's global figure state.
+'''
+
+import numpy as np
+
+# matplotlib's viridis colormap as 256 RGB byte triplets, i.e. viridis(range(256), bytes=True)
+VIRIDIS_HEX = (
+    '44015444025544035745055845065a45085b46095c460b5e460c5f460e61470f62471163471265471466471567471669'
+    '47186a48196b481a6c481c6e481d6f481e70482071482172482273482374472575472676472777472878472a79472b7a'
+    '472c7b462d7c462f7c46307d46317e45327f45347f453580453681443781443982433a83433b83433c84423d84423e85'
+    '4240854141864142864043874044873f45873f47883e48883e49893d4a893d4b893d4c893c4d8a3c4e8a3b508a3b518a'
+    '3a528b3a538b39548b39558b38568b38578c37588c37598c365a8c365b8c355c8c355d8c345e8d345f8d33608d33618d'
+    '32628d32638d31648d31658d31668d30678d30688d2f698d2f6a8d2e6b8e2e6c8e2e6d8e2d6e8e2d6f8e2c708e2c718e'
+    '2c728e2b738e2b748e2a758e2a768e2a778e29788e29798e287a8e287a8e287b8e277c8e277d8e277e8e267f8e26808e'
+    '26818e25828e25838d24848d24858d24868d23878d23888d23898d22898d228a8d228b8d218c8d218d8c218e8c208f8c'
+    '20908c20918c1f928c1f938b1f948b1f958b1f968b1e978a1e988a1e998a1e998a1e9a891e9b891e9c891e9d881e9e88'
+    '1e9f881ea0871fa1871fa2861fa38620a48520a58521a68521a78422a78423a88323a98224aa8225ab8126ac8127ad80'
+    '28ae7f29af7f2ab07e2bb17d2cb17d2eb27c2fb37b30b47a32b57a33b67935b77836b87738b97639b9763bba753dbb74'
+    '3ebc7340bd7242be7144be7045bf6f47c06e49c16d4bc26c4dc26b4fc36951c46853c56755c66657c66559c7645bc862'
+    '5ec96160c96062ca5f64cb5d67cc5c69cc5b6bcd596dce5870ce5672cf5574d05477d05279d1517cd24f7ed24e81d34c'
+    '83d34b86d44988d5478bd5468dd64490d64392d74195d73f97d83e9ad83c9dd93a9fd938a2da37a5da35a7db33aadb32'
+    'addc30afdc2eb2dd2cb5dd2bb7dd29bade27bdde26bfdf24c2df22c5df21c7e01fcae01ecde01dcfe11cd2e11bd4e11a'
+    'd7e219dae218dce218dfe318e1e318e4e318e7e419e9e419ece41aeee51bf1e51cf3e51ef6e61ff8e621fae622fde724'
+)
+
+
+def build_viridis_lut():
+    """Return the viridis colormap as a (256, 3) uint8 RGB table."""
+    return np.frombuffer(bytearray.fromhex(''.join(VIRIDIS_HEX)), dtype='uint8').reshape(256, 3)
+
+VIRIDIS_LUT = build_viridis_lut()
+
+
+def lut_indices(values, vmin=0.0, vmax=1.0):
+    """Map values to colour table indices 0-255 the way a matplotlib colormap does.
+
+    vmin maps to 0, vmax to 255 and values outside the range are clipped; NaN maps to 0.
+    """
+    scaled = np.subtract(values, vmin, dtype='float32')
+    np.multiply(scaled, 256.0 / (vmax - vmin), out=scaled)
+    np.clip(scaled, 0, 255, out=scaled)
+    np.copyto(scaled, 0, where=np.isnan(scaled))
+    return scaled.astype('uint8')
+
+
+def render_pseudocolor(values, path, vmin=0.0, vmax=1.0, lut=VIRIDIS_LUT):
+    """Save values as a pseudocoloured RGB PNG with one pixel per value."""
+    from PIL import Image
+
+    Image.fromarray(lut[lut_indices(values, vmin, vmax)], 'RGB').save(path)
+    return path
+
+
+def fixed_histogram(values, bins=20, vmin=0.0, vmax=1.0):
+    """Count values in equal-width bins over [vmin, vmax], like np.histogram with a range.
+
+    Values outside the range (and NaN) are not counted; vmax falls in the last bin.
+    Returns (counts, bin edges).
+    """
+    values = np.asarray(values).ravel()
+    with np.errstate(invalid='ignore'):
+        inside = (values >= vmin) & (values <= vmax)
+    index = np.multiply(np.subtract(values[inside], vmin), bins / float(vmax - vmin))
+    index = np.minimum(index.astype('intp'), bins - 1)
+    counts = np.bincount(index, minlength=bins)
+    return counts, np.linspace(vmin, vmax, bins + 1)
+
+
+def render_histogram_chart(counts, edges, path, xlabel="Fv/Fm", ylabel="Pixels"):
+    """Draw counts as a bar chart PNG with matplotlib's Agg backend."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    width = 0.7 * (edges[1] - edges[0])
+    center = (edges[:-1] + edges[1:]) / 2
+    ax.bar(center, counts, align='center', width=width)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    fig.savefig(path)
+    return path
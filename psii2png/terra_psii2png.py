@@ -1,93 +1,149 @@
 #!/usr/bin/env python
 
 import os
-import numpy as np
-from PIL import Image
-from matplotlib import pyplot as plt
+import threading
+import multiprocessing
+from collections import deque
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 from pyclowder.utils import CheckMessage
 from pyclowder.files import upload_to_dataset
 from pyclowder.datasets import download_metadata, upload_metadata, submit_extraction
 from terrautils.extractors import TerrarefExtractor, is_latest_file, load_json_file, \
-    build_metadata, build_dataset_hierarchy
+    build_metadata
 from terrautils.metadata import get_extractor_metadata, get_terraref_metadata
-from terrautils.formats import create_geotiff, create_image
 from terrautils.spatial import geojson_to_tuples
 
+from hierarchy_cache import resolve_dataset, invalidate_on_404
+from psii_frames import get_image_dimensions, read_frame, FrameStats, fvfm_kernel
+from capture_tracker import CAPTURE_FILES, get_tracker, frame_index, index_frames, is_complete
+from psii_render import render_pseudocolor, fixed_histogram, render_histogram_chart
+
+
+def add_local_arguments(parser):
+    # add any additional arguments to parser
+    parser.add_argument('--encode-workers', dest="encode_workers", type=int, default=multiprocessing.cpu_count(),
+                        help="worker processes encoding frame PNGs and GeoTIFFs (1 = encode in the extractor process)")
+    parser.add_argument('--upload-queue', dest="upload_queue", type=int, default=8,
+                        help="encoded frames that may wait for upload; while it is full, no more frames are read or sent to the encode workers")
+    parser.add_argument('--fmax-window', dest="fmax_window", type=int, default=None,
+                        help="stop scanning frames for F-max this many frames after the pulse peak (default: scan all frames)")
+
+def export_frame(job):
+    """Create the PNG and GeoTIFF for one raw frame; runs in an encode worker process.
+
+    The frame's pixels come with the job if the extractor already read them, otherwise
+    they are read from the .bin file. Returns the job, without the pixels, with the
+    size of the PNG.
+    """
+    # formats pulls in matplotlib and netCDF4; only import it once there is a frame to convert
+    from terrautils.formats import create_geotiff, create_image
+
+    pixels = job.pop('pixels', None)
+    if pixels is None:
+        pixels = read_frame(job['bin_file'], job['width'], job['height'])
+    create_image(pixels, job['png_path'])
+    create_geotiff(pixels, job['gps_bounds'], job['tif_path'], None, False, job['extractor_info'], job['metadata'])
+    job['png_size'] = os.path.getsize(job['png_path'])
+    return job
+
+class UploadQueue(object):
+    """Uploads files to one Clowder dataset from a background thread, in the order they are queued.
+
+    put() blocks while maxsize files are waiting, so encoding cannot run far ahead
+    of the uploads. close() waits for the queue to drain and re-raises the first
+    upload error.
+    """
+
+    def __init__(self, connector, host, secret_key, target_dsid, maxsize=8):
+        self.connector = connector
+        self.host = host
+        self.secret_key = secret_key
+        self.target_dsid = target_dsid
+        self.queue = Queue(maxsize=max(maxsize, 1))
+        self.file_ids = {}
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, key, path):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((key, path))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                key, path = item
+                try:
+                    with invalidate_on_404(self.target_dsid):
+                        self.file_ids[key] = upload_to_dataset(self.connector, self.host, self.secret_key,
+                                                               self.target_dsid, path)
+                except Exception as ex:
+                    self.error = ex
+
+    def close(self):
+        """Wait for every queued upload and return the file ids ordered by key."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return [self.file_ids[k] for k in sorted(self.file_ids)]
+
 
 class PSIIBin2Png(TerrarefExtractor):
     def __init__(self):
         super(PSIIBin2Png, self).__init__()
 
+        add_local_arguments(self.parser)
+
         # parse command line and load default logging configuration
         self.setup(sensor='ps2_png')
 
+        self.encode_workers = self.args.encode_workers
+        self.upload_queue = self.args.upload_queue
+        self.fmax_window = self.args.fmax_window
+
     def get_image_dimensions(self, metadata):
         """Returns (image width, image height)"""
+        return get_image_dimensions(metadata)
 
-        if 'sensor_fixed_metadata' in metadata:
-            dims = metadata['sensor_fixed_metadata']['camera_resolution']
-            return dims.split("x")
-        else:
-            # Default based on original fixed metadata
-            return (1936, 1216)
-
-    def load_png(self, file_path, height, width):
-        """Load PNG image into a numpy array"""
-        im = Image.open(file_path)
-        return np.array(im).astype('uint8')
-
-    def analyze(self, img_width, img_height, frames, hist_path, coloredImg_path):
-
-        fdark = self.load_png(frames[0], img_height, img_width)
-        fmin = self.load_png(frames[1], img_height, img_width)
-
-        # Calculate the maximum fluorescence for each frame
-        fave = []
-        fave.append(np.max(fdark))
-        # Calculate the maximum value for frames 2 through 100. Bin file 101 is an XML file that lists the frame times
-        for i in range(2, 101):
-            img = self.load_png(frames[i], img_height, img_width)
-            fave.append(np.max(img))
-
-        # Assign the first image with the most fluorescence as F-max
-        fmax = self.load_png(frames[np.where(fave == np.max(fave))[0][0]], img_height, img_width)
-        # Calculate F-variable (F-max - F-min)
-        fv = np.subtract(fmax, fmin)
-        # Calculate Fv/Fm (F-variable / F-max)
-        try:
-            fvfm = np.divide(fv.astype('float'), fmax.astype('float'))
-        except:
-            fvfm = 0
-        # Fv/Fm will generate invalid values, such as division by zero
-        # Convert invalid values to zero. Valid values will be between 0 and 1
-        fvfm[np.where(np.isnan(fvfm))] = 0
-        fvfm[np.where(np.isinf(fvfm))] = 0
-        fvfm[np.where(fvfm > 1.0)] = 0
-
-        # Plot Fv/Fm (pseudocolored)
-        plt.imshow(fvfm, cmap="viridis")
-        plt.savefig(coloredImg_path)
-        plt.show()
-        plt.close()
-
-        # Calculate histogram of Fv/Fm values from the whole image
-        hist, bins = np.histogram(fvfm, bins=20)
-        # Plot Fv/Fm histogram
-        width = 0.7 * (bins[1] - bins[0])
-        center = (bins[:-1] + bins[1:]) / 2
-        plt.bar(center, hist, align='center', width=width)
-        plt.xlabel("Fv/Fm")
-        plt.ylabel("Pixels")
-        plt.show()
-        plt.savefig(hist_path)
-        plt.close()
+    def analyze(self, frame_stats, hist_path, coloredImg_path):
+        # F-min and F-max (the first frame with the most fluorescence) were kept while the frames were read
+        # Fv/Fm = (F-max - F-min) / F-max; pixels where that is undefined or above 1 are 0
+        fvfm, valid, fvfm_stats = fvfm_kernel(frame_stats.fmax, frame_stats.fmin)
+
+        # Fv/Fm (pseudocolored) at sensor resolution
+        render_pseudocolor(fvfm, coloredImg_path)
+
+        # Histogram of Fv/Fm values from the whole image over 20 fixed bins in [0, 1]
+        hist, bins = fixed_histogram(fvfm, bins=20)
+        render_histogram_chart(hist, bins, hist_path)
+
+        return fvfm_stats
 
     def check_message(self, connector, host, secret_key, resource, parameters):
+        # Every file.added event of a capture lands here; only the one that completes it needs real work
+        tracker = get_tracker(self.extractor_info['name'])
+        if tracker.claimed(resource['id']) and not self.overwrite:
+            self.log_skip(resource, "capture already dispatched")
+            return CheckMessage.ignore
+
         # Check for 0000-0101 bin files before beginning processing
-        if len(resource['files']) < 102:
+        if len(resource['files']) < CAPTURE_FILES:
             self.log_skip(resource, "less than 102 files found")
             return CheckMessage.ignore
+        frames = index_frames(resource['files'])
+        if not is_complete(frames):
+            self.log_skip(resource, "less than 102 .bin files found")
+            return CheckMessage.ignore
         if not is_latest_file(resource):
             self.log_skip(resource, "not latest file")
             return CheckMessage.ignore
@@ -96,34 +152,22 @@ class PSIIBin2Png(TerrarefExtractor):
         hist_path = self.sensors.get_sensor_path(timestamp, opts=['combined_hist'])
         coloredImg_path = self.sensors.get_sensor_path(timestamp, opts=['combined_pseudocolored'])
 
-        # Count number of bin files in dataset, as well as number of existing outputs
-        ind_add = 0
-        ind_output = 0
-        for ind in range(0, 102):
-            format_ind = "{0:0>4}".format(ind) # e.g. 1 becomes 0001
-            for f in resource['files']:
-                if f['filename'].endswith(format_ind+'.bin'):
-                    ind_add += 1
-                    out_png = self.sensors.get_sensor_path(timestamp, opts=[format_ind])
-                    if os.path.exists(out_png) and not self.overwrite:
-                        ind_output += 1
-                    break
-
-        # Do the outputs already exist?
-        if ind_output == 102 and os.path.exists(hist_path) and os.path.exists(coloredImg_path):
+        # Do the outputs already exist? Frames 0000-0100 each have a PNG; 0101 is the frame time list
+        if not self.overwrite and os.path.exists(hist_path) and os.path.exists(coloredImg_path) and \
+                all(os.path.exists(self.sensors.get_sensor_path(timestamp, opts=["{0:0>4}".format(ind)]))
+                    for ind in range(0, CAPTURE_FILES - 1)):
             self.log_skip(resource, "outputs already exist")
-            return CheckMessage.ignore
-        # Do we have too few input BIN files?
-        if ind_add < 102:
-            self.log_skip(resource, "less than 102 .bin files found")
+            tracker.complete(resource['id'])
             return CheckMessage.ignore
 
         # Check metadata to verify we have what we need
         md = download_metadata(connector, host, secret_key, resource['id'])
         if get_extractor_metadata(md, self.extractor_info['name']) and not self.overwrite:
             self.log_skip(resource, "metadata indicates it was already processed")
+            tracker.complete(resource['id'])
             return CheckMessage.ignore
         if get_terraref_metadata(md):
+            tracker.claim(resource['id'])
             return CheckMessage.download
         else:
             self.log_error(resource, "no terraref metadata found; sending to cleaner")
@@ -131,6 +175,18 @@ class PSIIBin2Png(TerrarefExtractor):
             return CheckMessage.ignore
 
     def process_message(self, connector, host, secret_key, resource, parameters):
+        tracker = get_tracker(self.extractor_info['name'])
+        processed = False
+        try:
+            processed = self.process_capture(connector, host, secret_key, resource, parameters)
+        finally:
+            if processed:
+                tracker.complete(resource['id'])
+            else:
+                # the claim made in check_message would hide retries and resubmissions until it expires
+                tracker.release(resource['id'])
+
+    def process_capture(self, connector, host, secret_key, resource, parameters):
         self.start_message(resource)
 
         # Get bin files and metadata
@@ -144,14 +200,14 @@ class PSIIBin2Png(TerrarefExtractor):
             elif f.endswith('_metadata.json') and f.find('/_metadata.json') == -1 and metadata is None:
                 metadata = load_json_file(f)
         frames = {}
-        for ind in range(0, 101):
-            format_ind = "{0:0>4}".format(ind) # e.g. 1 becomes 0001
-            for f in resource['local_paths']:
-                if f.endswith(format_ind+'.bin'):
-                    frames[ind] = f
+        for f in resource['local_paths']:
+            ind = frame_index(f)
+            if ind is not None and ind < 101:
+                frames[ind] = f
         if None in [metadata] or len(frames) < 101:
             self.log_error(resource, 'could not find all of frames/metadata')
-            return
+            # let a later event of this capture try again
+            return False
 
         # Determine output directory
         timestamp = resource['dataset_info']['name'].split(" - ")[1]
@@ -159,39 +215,78 @@ class PSIIBin2Png(TerrarefExtractor):
         coloredImg_path = self.sensors.create_sensor_path(timestamp, opts=['combined_pseudocolored'])
         uploaded_file_ids = []
 
-        target_dsid = build_dataset_hierarchy(host, secret_key, self.clowder_user, self.clowder_pass, self.clowderspace,
-                                              self.sensors.get_display_name(),
-                                              timestamp[:4], timestamp[5:7], timestamp[8:10],
-                                              leaf_ds_name=self.sensors.get_display_name()+' - '+timestamp)
+        target_dsid = resolve_dataset(host, secret_key, self.clowder_user, self.clowder_pass, self.clowderspace,
+                                      None, None, self.sensors.get_display_name(), timestamp[:10],
+                                      self.sensors.get_display_name()+' - '+timestamp)
 
         (img_width, img_height) = self.get_image_dimensions(metadata)
         gps_bounds = geojson_to_tuples(metadata['spatial_metadata']['ps2Top']['bounding_box'])
 
         self.log_info(resource, "image dimensions (w, h): (%s, %s)" % (img_width, img_height))
 
-        png_frames = {}
-        for ind in range(0, 101):
-            format_ind = "{0:0>4}".format(ind) # e.g. 1 becomes 0001
-            png_path = self.sensors.create_sensor_path(timestamp, opts=[format_ind])
-            tif_path = png_path.replace(".png", ".tif")
-            png_frames[ind] = png_path
-            if not os.path.exists(png_path) or self.overwrite:
-                self.log_info(resource, "generating and uploading %s" % png_path)
-                pixels = np.fromfile(frames[ind], np.dtype('uint8')).reshape([int(img_height), int(img_width)])
-                create_image(pixels, png_path)
-                create_geotiff(pixels, gps_bounds, tif_path, None, False, self.extractor_info, metadata)
-
-                if png_path not in resource['local_paths']:
-                    fileid = upload_to_dataset(connector, host, secret_key, target_dsid, png_path)
-                    uploaded_file_ids.append(fileid)
-                self.created += 1
-                self.bytes += os.path.getsize(png_path)
+        # Frames that still need their PNG and GeoTIFF
+        png_paths = [self.sensors.create_sensor_path(timestamp, opts=["{0:0>4}".format(ind)]) for ind in range(0, 101)]
+        todo = set(ind for ind in range(0, 101) if not os.path.exists(png_paths[ind]) or self.overwrite)
+
+        # Each frame is read once: its statistics are gathered and its pixels handed to an encode worker
+        # right away, so encoding overlaps reading and a background thread uploads the finished PNGs
+        frame_stats = FrameStats(fmax_window=self.fmax_window)
+        uploads = pool = None
+        if todo:
+            self.log_info(resource, "generating and uploading %s frames with %s encode workers" % (len(todo), self.encode_workers))
+            uploads = UploadQueue(connector, host, secret_key, target_dsid, self.upload_queue)
+            pool = multiprocessing.Pool(self.encode_workers) if self.encode_workers > 1 else None
+        # frames sent to the encoders and not yet queued for upload; when the upload queue is full,
+        # queuing the oldest blocks, so no further frames are read or encoded until uploads catch up
+        pending = deque()
+        max_pending = 2 * self.encode_workers if pool else 0
+        try:
+            for ind in range(0, 101):
+                pixels = None
+                # frames past the F-max window are only read by the encode workers, if at all
+                if not frame_stats.finished():
+                    pixels = read_frame(frames[ind], img_width, img_height)
+                    frame_stats.add(ind, pixels)
+                if ind in todo:
+                    job = {
+                        'ind': ind,
+                        'bin_file': frames[ind],
+                        'pixels': pixels,
+                        'width': int(img_width),
+                        'height': int(img_height),
+                        'png_path': png_paths[ind],
+                        'tif_path': png_paths[ind].replace(".png", ".tif"),
+                        'gps_bounds': gps_bounds,
+                        'extractor_info': self.extractor_info,
+                        'metadata': metadata
+                    }
+                    pending.append(pool.apply_async(export_frame, (job,)) if pool else export_frame(job))
+                while len(pending) > max_pending or (ind == 100 and pending):
+                    job = pending.popleft()
+                    if pool:
+                        job = job.get()
+                    if job['png_path'] not in resource['local_paths']:
+                        uploads.put(job['ind'], job['png_path'])
+                    self.created += 1
+                    self.bytes += job['png_size']
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            if uploads:
+                uploaded_file_ids += uploads.close()
 
         # Generate aggregate outputs
         self.log_info(resource, "generating aggregates")
         if not (os.path.exists(hist_path) and os.path.exists(coloredImg_path)) or self.overwrite:
             # TODO: Coerce histogram and pseudocolor to geotiff?
-            self.analyze(int(img_width), int(img_height), png_frames, hist_path, coloredImg_path)
+            self.log_info(resource, "F-max is frame %s (max %s), found scanning %s frames" % (
+                frame_stats.fmax_index, frame_stats.max[frame_stats.fmax_index], frame_stats.seen.sum()))
+            if self.fmax_window is not None and not frame_stats.scanner.armed:
+                self.log_info(resource, "no saturating pulse found above the F0/Fmin mean; every frame was scanned")
+            fvfm_stats = self.analyze(frame_stats, hist_path, coloredImg_path)
+            self.log_info(resource, "Fv/Fm over %s valid pixels: mean %.4f, std %.4f, min %.4f, max %.4f" % (
+                fvfm_stats['valid_count'], fvfm_stats['mean'], fvfm_stats['std'], fvfm_stats['min'], fvfm_stats['max']))
             self.created += 2
             self.bytes += os.path.getsize(hist_path) + os.path.getsize(coloredImg_path)
         if hist_path not in resource['local_paths']:
@@ -208,6 +303,7 @@ class PSIIBin2Png(TerrarefExtractor):
         upload_metadata(connector, host, secret_key, resource['id'], metadata)
 
         self.end_message(resource)
+        return True
 
 if __name__ == "__main__":
     extractor = PSIIBin2Png()
@@ -1,5 +1,11 @@
 
-function PSII(path_dark, path_light, outputfilename)
+function PSII(path_dark, path_light, outputfilename, width, height)
+
+% width and height are the frame dimensions in pixels (default 1936 x 1216)
+if nargin < 5
+  width = 1936;
+  height = 1216;
+end
 
 % This script computes all characterisitc fluorescence features for
 % dark and light-adapted plants
@@ -28,7 +34,12 @@ function PSII(path_dark, path_light, outputfilename)
 % qP             -  1936-by-1216        double  Proportion of open PSII reaction centers
 % Rfd            -  1936-by-1216        double  ratio of chlorophyll decrease to steady state Chlorophyll
 
-pkg image load
+% load the image package once per Octave session; psii_server.m calls PSII for every capture
+persistent image_loaded
+if isempty(image_loaded)
+  pkg image load
+  image_loaded = true;
+end
 %outputfilename=''
 
 %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%% load dark adapted PSII data %%%%%%%%%%%%%%%
@@ -49,7 +60,7 @@ end
 for i=1:size(D,1)-1 % frame 101 is metadata
   if ~isempty(findstr(D(i).name,'bin')) 
     % read frames
-    A= Read_FileOrFolder(path_dark,i,IsItFile);
+    A= Read_FileOrFolder(path_dark,i,IsItFile,width,height);
     A=double(A)./255;
     % Mean intensity
     M(i)=mean(mean(A));
@@ -60,7 +71,7 @@ end
 
 % Fbase = intensity of first frame (without red flash) as base line to subtract
 Fbase_i=find(FrameIndex==1);
-F_base= Read_FileOrFolder(path_dark,Fbase_i,IsItFile);
+F_base= Read_FileOrFolder(path_dark,Fbase_i,IsItFile,width,height);
 F_base = double(F_base)./255; % convert to double
 
 % chose frame for Fmax as second highest max value to avoid outlier
@@ -68,22 +79,22 @@ F_base = double(F_base)./255; % convert to double
 Fm_i=SortID(end-1);
 
 
-Fm_dark= Read_FileOrFolder(path_dark,Fm_i,IsItFile);
+Fm_dark= Read_FileOrFolder(path_dark,Fm_i,IsItFile,width,height);
 Fm_dark = double(Fm_dark)./255-F_base; % convert to double
 
 Fm_dark_frame = FrameIndex(Fm_i);
 
 % F0
 F0_i=find(FrameIndex==2);
-F0_dark= Read_FileOrFolder(path_dark,F0_i,IsItFile);
+F0_dark= Read_FileOrFolder(path_dark,F0_i,IsItFile,width,height);
 F0_dark = double(F0_dark)./255-F_base; % convert to double
 
 % Compute mask from Fm Frame to exclude background
-FmHist=reshape(Fm_dark,1,1936*1216);
+FmHist=reshape(Fm_dark,1,width*height);
 
 % take 99%tile as max intensity as max value
 Fsort=sort(FmHist);
-Fmax=Fsort(int32(1936*1216*0.99));
+Fmax=Fsort(int32(width*height*0.99));
 
 % set threshold to 10% of found max value
 Fmask_dark=Fm_dark>0.1*Fmax;
@@ -120,7 +131,7 @@ for i=1:size(D,1)-1 % frame 101 is metadata
   if ~isempty(findstr(D(i).name,'bin'))
     % read frames
 
-    A = Read_FileOrFolder(path_light,i,IsItFile);
+    A = Read_FileOrFolder(path_light,i,IsItFile,width,height);
     A=double(A)./255;
     
     % Mean intensity
@@ -134,7 +145,7 @@ end
 
 % Fbase = intensity of first frame (without red flash) as base line to subtract
 Fbase_i=find(FrameIndex==1);
-F_base = Read_FileOrFolder(path_light,Fbase_i,IsItFile);
+F_base = Read_FileOrFolder(path_light,Fbase_i,IsItFile,width,height);
 F_base = double(F_base)./255; % convert to double
 
 
@@ -145,14 +156,14 @@ Fm_i=SortID(end-1);
 
 % Fm subtracted by F_base
 
-Fm_light = Read_FileOrFolder(path_light,Fm_i,IsItFile);
+Fm_light = Read_FileOrFolder(path_light,Fm_i,IsItFile,width,height);
 Fm_light = double(Fm_light)./255-F_base; % convert to double
 
 Fm_light_frame = FrameIndex(Fm_i);
 
 % F0
 F0_i=find(FrameIndex==2);
-F0_light = Read_FileOrFolder(path_light,F0_i,IsItFile);
+F0_light = Read_FileOrFolder(path_light,F0_i,IsItFile,width,height);
 F0_light_adapt = double(F0_light)./255-F_base; % convert to double
 
 % Computation of F0_light after Oxborough & Baker 1997: Photosynthesis research, 54: 135-142.
@@ -166,11 +177,11 @@ Ft_light = F0_light-F0_dark;
 
 
 % Compute mask from Fm Frame to exclude background
-FmHist=reshape(Fm_light,1,1936*1216);
+FmHist=reshape(Fm_light,1,width*height);
 
 % take 99%tile as max intensity as max value
 Fsort=sort(FmHist);
-Fmax=Fsort(int32(1936*1216*0.99));
+Fmax=Fsort(int32(width*height*0.99));
 
 % set threshold to 10% of found max value
 Fmask_light=Fm_light>0.1*Fmax;
@@ -254,14 +265,14 @@ end
 
 
 
-function output= Read_FileOrFolder(path,index,IsItFile)
+function output= Read_FileOrFolder(path,index,IsItFile,width,height)
 
 output=0;
 
   if IsItFile
     D=dir(path);
     fileID = fopen(fullfile(path,D(index).name));
-    A = fread(fileID,[1936,1216],'uint8');
+    A = fread(fileID,[width,height],'uint8');
     fclose(fileID);
     output=A;	
   else
@@ -273,7 +284,7 @@ output=0;
 	files = {files.name};
 	fname = fullfile(path,dirName,files{1});
         fileID = fopen(fname);
-        A = fread(fileID,[1936,1216],'uint8');
+        A = fread(fileID,[width,height],'uint8');
         fclose(fileID);
 	output = A;
       end
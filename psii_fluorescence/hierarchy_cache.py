@@ -0,0 +1,173 @@
+'''
+Process-local cache of resolved Clowder dataset hierarchies
+
+Consecutive messages for the same day resolve the same season / experiment /
+sensor / year / month / date collections, but each message has its own leaf
+dataset. resolve_dataset caches the date collection separately from the leaf,
+so every message after the first of a day only looks up its leaf dataset.
+
+Configuration (environment):
+    HIERARCHY_CACHE_TTL  -- seconds a resolved id stays valid (default 3600, 0 disables caching)
+    HIERARCHY_CACHE_FILE -- optional JSON file to persist the cache across restarts
+
+Each extractor using this file has its own copy; tests/test_shared_modules.py
+checks that the copies are identical.
+'''
+
+import os
+import json
+import time
+import logging
+import hashlib
+from contextlib import contextmanager
+
+DEFAULT_TTL = 3600
+
+# argument types that identify a hierarchy; connectors and other objects are skipped
+KEY_TYPES = (str, int, float, bool, type(None), type(u''))
+
+
+class HierarchyCache(object):
+    """Map hierarchy lookups to resolved Clowder ids with TTL eviction."""
+
+    def __init__(self, ttl=DEFAULT_TTL, cache_file=None):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.entries = {}
+        if cache_file:
+            self.load()
+
+    @staticmethod
+    def make_key(builder, args, kwargs):
+        # Hashed so credentials in the arguments never reach the on-disk file
+        parts = [getattr(builder, '__name__', str(builder))]
+        parts += [a for a in args if isinstance(a, KEY_TYPES)]
+        parts += sorted([k, v] for k, v in kwargs.items() if isinstance(v, KEY_TYPES))
+        return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.time():
+            del self.entries[key]
+            return None
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (value, time.time() + self.ttl)
+        if self.cache_file:
+            self.save()
+
+    def invalidate(self, value):
+        """Drop every key that resolved to value (e.g. a dataset id that returned 404)."""
+        stale = [k for k, entry in self.entries.items() if entry[0] == value]
+        for k in stale:
+            del self.entries[k]
+        if stale and self.cache_file:
+            self.save()
+        return len(stale)
+
+    def resolve(self, builder, *args, **kwargs):
+        """Return builder(*args, **kwargs), reusing a cached result for identical arguments."""
+        if self.ttl <= 0:
+            return builder(*args, **kwargs)
+
+        key = self.make_key(builder, args, kwargs)
+        value = self.get(key)
+        if value is None:
+            value = builder(*args, **kwargs)
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def load(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                now = time.time()
+                for key, entry in json.load(f).items():
+                    if entry[1] >= now:
+                        self.entries[key] = (entry[0], entry[1])
+        except (IOError, OSError, ValueError):
+            # missing or unreadable cache file just means a cold cache
+            pass
+
+    def save(self):
+        tmp_file = self.cache_file + '.%s.tmp' % os.getpid()
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self.entries, f)
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError) as ex:
+            logging.getLogger(__name__).warning("could not write hierarchy cache %s: %s" % (self.cache_file, str(ex)))
+
+
+_cache = None
+
+def get_cache():
+    """Return the process-wide HierarchyCache, configured from the environment on first use."""
+    global _cache
+    if _cache is None:
+        _cache = HierarchyCache(int(os.environ.get('HIERARCHY_CACHE_TTL', DEFAULT_TTL)),
+                                os.environ.get('HIERARCHY_CACHE_FILE') or None)
+    return _cache
+
+
+def resolve_hierarchy(builder, *args, **kwargs):
+    """Cached equivalent of builder(*args, **kwargs), e.g. build_day_collection."""
+    return get_cache().resolve(builder, *args, **kwargs)
+
+
+def build_day_collection(host, secret_key, clowder_user, clowder_pass, root_space, season, experiment, sensor, date_str):
+    """Resolve the [season / experiment /] sensor / year / month / date collections and return the date collection id.
+
+    Mirrors the collection part of build_dataset_hierarchy_crawl; season and
+    experiment may be None for sensors filed directly under the space.
+    """
+    from terrautils.extractors import get_collection_or_create, ensure_collection_in_children
+
+    year, month, date = date_str[:4], date_str[5:7], date_str[8:10]
+    if season and experiment:
+        season_c = get_collection_or_create(host, secret_key, clowder_user, clowder_pass, season, parent_space=root_space)
+        experiment_c = ensure_collection_in_children(host, secret_key, clowder_user, clowder_pass, root_space, season_c, experiment)
+        sensor_c = ensure_collection_in_children(host, secret_key, clowder_user, clowder_pass, root_space, experiment_c, sensor)
+    else:
+        sensor_c = get_collection_or_create(host, secret_key, clowder_user, clowder_pass, sensor, parent_space=root_space)
+    year_c = ensure_collection_in_children(host, secret_key, clowder_user, clowder_pass, root_space, sensor_c,
+                                           "%s - %s" % (sensor, year))
+    month_c = ensure_collection_in_children(host, secret_key, clowder_user, clowder_pass, root_space, year_c,
+                                            "%s - %s-%s" % (sensor, year, month))
+    return ensure_collection_in_children(host, secret_key, clowder_user, clowder_pass, root_space, month_c,
+                                         "%s - %s-%s-%s" % (sensor, year, month, date))
+
+
+def resolve_dataset(host, secret_key, clowder_user, clowder_pass, root_space, season, experiment, sensor, date_str,
+                    leaf_ds_name):
+    """Return the id of dataset leaf_ds_name in the date collection of date_str, creating what is missing.
+
+    The date collection is cached per day, so a day's messages resolve it once;
+    only the leaf dataset is looked up (and cached) per dataset name.
+    """
+    from terrautils.extractors import get_dataset_or_create
+
+    day_collection = resolve_hierarchy(build_day_collection, host, secret_key, clowder_user, clowder_pass, root_space,
+                                       season, experiment, sensor, date_str)
+    with invalidate_on_404(day_collection):
+        return resolve_hierarchy(get_dataset_or_create, host, secret_key, clowder_user, clowder_pass, leaf_ds_name,
+                                 day_collection, root_space)
+
+
+@contextmanager
+def invalidate_on_404(resolved_id):
+    """Forget resolved_id if a request inside the block fails with HTTP 404.
+
+    The error is re-raised; the next message resolves the hierarchy from Clowder again.
+    """
+    try:
+        yield
+    except Exception as ex:
+        response = getattr(ex, 'response', None)
+        if response is not None and getattr(response, 'status_code', None) == 404:
+            get_cache().invalidate(resolved_id)
+        raise
@@ -0,0 +1,173 @@
+'''
+Persistent Octave workers for PSII.m
+
+Each worker is an Octave process running psii_server.m, which loads the image
+package and PSII.m once and then evaluates one command per line from its stdin.
+Commands are sent over the pipe and each returns its timing; a worker that dies
+or exceeds its timeout is killed and restarted.
+'''
+
+import os
+import time
+import logging
+import threading
+import subprocess
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+READY = '__READY__'
+DONE = '__DONE__'
+
+logger = logging.getLogger(__name__)
+
+
+class OctaveError(Exception):
+    pass
+
+
+class OctaveTimeout(OctaveError):
+    pass
+
+
+def octave_string(value):
+    """Quote value as an Octave single-quoted string."""
+    return "'%s'" % value.replace("'", "''")
+
+
+class OctaveWorker(object):
+    """One Octave process running psii_server.m, talked to over stdin/stdout."""
+
+    def __init__(self, workdir=None, octave='octave', startup_timeout=120):
+        self.workdir = workdir or os.path.dirname(os.path.abspath(__file__))
+        self.octave = octave
+        self.startup_timeout = startup_timeout
+        self.proc = None
+        self.lines = None
+
+    def start(self):
+        self.proc = subprocess.Popen([self.octave, '--quiet', '--no-gui', '--norc', '--eval', 'psii_server'],
+                                     cwd=self.workdir, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, universal_newlines=True)
+        # A reader thread turns stdout into a queue so reads can time out
+        self.lines = Queue()
+        reader = threading.Thread(target=self._read_output, args=(self.proc.stdout, self.lines))
+        reader.daemon = True
+        reader.start()
+
+        try:
+            self._wait_for(READY, self.startup_timeout)
+        except OctaveError:
+            self.stop()
+            raise
+
+    @staticmethod
+    def _read_output(stdout, lines):
+        for line in iter(stdout.readline, ''):
+            lines.put(line.rstrip('\n'))
+        lines.put(None)
+
+    def _wait_for(self, marker, timeout):
+        """Return the first output line starting with marker, logging the lines before it."""
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            remaining = deadline - time.time() if deadline else None
+            if remaining is not None and remaining <= 0:
+                raise OctaveTimeout("no response from Octave within %s seconds" % timeout)
+            try:
+                line = self.lines.get(timeout=remaining)
+            except Empty:
+                raise OctaveTimeout("no response from Octave within %s seconds" % timeout)
+            if line is None:
+                raise OctaveError("Octave exited with code %s" % self.proc.wait())
+            if line.startswith(marker):
+                return line
+            logger.debug("octave: %s" % line)
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def call(self, command, timeout=None):
+        """Evaluate one line of Octave code and return (wall seconds, Octave seconds).
+
+        Raises OctaveError if the command fails, and OctaveTimeout (after killing the
+        worker) if it takes longer than timeout seconds. A dead worker is restarted
+        before the command is sent.
+        """
+        if not self.alive():
+            self.start()
+
+        started = time.time()
+        try:
+            self.proc.stdin.write(command.replace('\n', ' ') + '\n')
+            self.proc.stdin.flush()
+            status = self._wait_for(DONE, timeout).split(' ', 2)
+        except (IOError, OSError, OctaveError):
+            # the worker is in an unknown state; the next call starts a fresh one
+            self.stop()
+            raise
+        elapsed = time.time() - started
+
+        if len(status) < 2 or status[1] != 'ok':
+            raise OctaveError(status[2] if len(status) > 2 else "unknown Octave error")
+        return elapsed, float(status[2])
+
+    def stop(self):
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                try:
+                    self.proc.stdin.close()
+                    self.proc.kill()
+                except (IOError, OSError):
+                    pass
+                self.proc.wait()
+            self.proc = None
+
+
+class OctavePool(object):
+    """A fixed number of OctaveWorkers shared between threads.
+
+    With warm, the workers are started together when the pool is created, so the
+    first capture does not wait for Octave to load; a worker that fails to start
+    then, or dies later, is started again by its next call.
+    """
+
+    def __init__(self, size=1, warm=True, **worker_args):
+        workers = [OctaveWorker(**worker_args) for i in range(max(size, 1))]
+        if warm:
+            threads = [threading.Thread(target=self._warm, args=(worker,)) for worker in workers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.idle = Queue()
+        for worker in workers:
+            self.idle.put(worker)
+
+    @staticmethod
+    def _warm(worker):
+        try:
+            worker.start()
+        except (IOError, OSError, OctaveError) as ex:
+            logger.warning("could not start Octave worker: %s" % str(ex))
+
+    def call(self, command, timeout=None):
+        worker = self.idle.get()
+        try:
+            return worker.call(command, timeout)
+        finally:
+            self.idle.put(worker)
+
+    def psii(self, path_dark, path_light, out_base, timeout=None):
+        """Run PSII(path_dark, path_light, out_base) and return (wall seconds, Octave seconds)."""
+        return self.call("PSII(%s, %s, %s)" % (octave_string(path_dark), octave_string(path_light),
+                                              octave_string(out_base)), timeout)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().stop()
+            except Empty:
+                break
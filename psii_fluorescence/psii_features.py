@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+'''
+NumPy implementation of PSII.m
+
+Computes the dark- and light-adapted fluorescence features of a PSII capture
+(Fm, Fv, Fv/Fm dark and light, Phi_PSII, NPQ, qN, qP, Rfd) in-process, reading
+each frame once, and writes them as PNGs with the same names, orientation and
+scaling as PSII.m.
+
+Run as a script to compute the features of a capture and optionally compare
+them with PNGs written by PSII.m:
+
+    python psii_features.py <dark dir> <light dir> <output base> [--compare <PSII.m output base>]
+'''
+
+import os
+import math
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+from psii_frames import read_frame, FmaxScanner
+
+FEATURES = ("Fm_dark", "Fv_dark", "FvFm_dark", "Fm_light", "Fv_light", "FvFm_light",
+            "Phi_PSII", "NPQ", "qN", "qP", "Rfd")
+
+
+def find_frames(in_dir):
+    """Return {frame index: path} of the image frames in in_dir.
+
+    Frame indices come from the last four digits of each .bin name; frame 101
+    lists the frame times and is not an image.
+    """
+    frames = {}
+    for name in sorted(os.listdir(in_dir)):
+        if name.endswith('.bin') and name[-8:-4].isdigit():
+            ind = int(name[-8:-4])
+            if ind != 101:
+                frames[ind] = os.path.join(in_dir, name)
+    return frames
+
+
+def read_adapted_frames(frames, width, height, fmax_window=None):
+    """Read the frames of one capture once and return (F_base, Fm, F0, Fm frame index).
+
+    F_base is frame 1 (no red flash) and F0 frame 2, both as fractions of 255.
+    Fm is the frame with the second highest mean intensity, to avoid an outlier,
+    with ties ordered by frame index as in PSII.m. Fm and F0 have F_base subtracted.
+    With fmax_window, frames are no longer read once the mean has risen above
+    that of F_base and F0 and the two highest means have then not changed for
+    that many frames.
+    """
+    f_base = f0 = None
+    scanner = FmaxScanner(k=2, window=fmax_window)
+    for ind in sorted(frames):
+        pixels = read_frame(frames[ind], width, height)
+        mean = pixels.sum(dtype='uint64') / (255.0 * pixels.size)
+        if ind == 1:
+            f_base = pixels
+        elif ind == 2:
+            f0 = pixels
+        if ind in (1, 2):
+            scanner.add_baseline(mean)
+        scanner.add(ind, pixels, (mean, ind))
+        if scanner.finished() and f_base is not None and f0 is not None:
+            break
+
+    fm_index, fm = scanner.best(1)
+    if f_base is None or f0 is None or fm is None:
+        raise ValueError("capture is missing frame 1, frame 2 or an Fm candidate")
+
+    f_base = f_base / 255.0
+    return f_base, fm / 255.0 - f_base, f0 / 255.0 - f_base, fm_index
+
+
+def background_mask(fm):
+    """Pixels brighter than 10% of Fm's 99th percentile (by rank, as PSII.m takes it)."""
+    k = int(math.floor(fm.size * 0.99 + 0.5)) - 1
+    fmax = np.partition(fm.ravel(), k)[k]
+    return fm > 0.1 * fmax
+
+
+def compute_features(dark, light):
+    """Return an OrderedDict of the PSII.m features from (F_base, Fm, F0, index) tuples."""
+    fm_dark, f0_dark = dark[1], dark[2]
+    fm_light, f0_light_adapt = light[1], light[2]
+
+    features = OrderedDict()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mask_dark = background_mask(fm_dark)
+        fv_dark = (fm_dark - f0_dark) * mask_dark
+        fvfm_dark = (fv_dark / fm_dark) * mask_dark
+        fvfm_dark[np.isnan(fvfm_dark)] = 0
+
+        # F0_light after Oxborough & Baker 1997; Ft is assumed to be F0_light - F0_dark
+        f0_light = f0_dark / ((fv_dark / fm_dark) + f0_dark / fm_light)
+        ft_light = f0_light - f0_dark
+
+        mask_light = background_mask(fm_light)
+        fv_light = (fm_light - f0_light_adapt) * mask_light
+        fvfm_light = (fv_light / fm_light) * mask_light
+        fvfm_light[np.isnan(fvfm_light)] = 0
+        fvfm_light[fvfm_light < 0] = 0
+
+        features["Fm_dark"] = fm_dark
+        features["Fv_dark"] = fv_dark
+        features["FvFm_dark"] = fvfm_dark
+        features["Fm_light"] = fm_light
+        features["Fv_light"] = fv_light
+        features["FvFm_light"] = fvfm_light
+        features["Phi_PSII"] = (fm_light - ft_light) / fm_light * mask_light
+        features["NPQ"] = (fm_dark - fm_light) / fm_light * mask_light
+        features["qN"] = (fm_dark - fm_light) / (fm_dark - f0_dark) * mask_light
+        features["qP"] = (fm_light - ft_light) / (fm_dark - f0_dark) * mask_light
+        features["Rfd"] = (fm_dark / fm_light - 1) * mask_light
+
+    return features
+
+
+def to_uint8(values):
+    """Scale a [0, 1] feature image to uint8 like Octave's imwrite: clipped, rounded, NaN as 0."""
+    scaled = np.clip(values, 0, 1) * 255
+    scaled[np.isnan(scaled)] = 0
+    return np.floor(scaled + 0.5).astype('uint8')
+
+
+def write_features(features, out_base, transpose=True):
+    """Write <out_base>_<feature>.png for every feature and return the paths.
+
+    PSII.m reads frames column-major, so its PNGs are the transpose of the camera
+    image; transpose keeps that orientation for existing consumers.
+    """
+    from PIL import Image
+
+    paths = []
+    for name, values in features.items():
+        pixels = to_uint8(values)
+        if transpose:
+            pixels = pixels.T
+        path = out_base + "_" + name + ".png"
+        Image.fromarray(np.ascontiguousarray(pixels)).save(path)
+        paths.append(path)
+    return paths
+
+
+def psii_features(path_dark, path_light, out_base, width=1936, height=1216, fmax_window=None):
+    """Python equivalent of PSII(path_dark, path_light, out_base).
+
+    fmax_window stops reading a capture that many frames after its Fm candidates
+    settle (default: read every frame, as PSII.m does).
+
+    Returns (output paths, Fm_dark frame index, Fm_light frame index).
+    """
+    dark = read_adapted_frames(find_frames(path_dark), width, height, fmax_window)
+    if os.path.abspath(path_light) == os.path.abspath(path_dark):
+        light = dark
+    else:
+        light = read_adapted_frames(find_frames(path_light), width, height, fmax_window)
+
+    paths = write_features(compute_features(dark, light), out_base)
+    return paths, dark[3], light[3]
+
+
+def compare_outputs(out_base, octave_base):
+    """Return {feature: (max abs difference, differing pixels)} between two sets of feature PNGs."""
+    from PIL import Image
+
+    diffs = OrderedDict()
+    for name in FEATURES:
+        ours = np.asarray(Image.open(out_base + "_" + name + ".png"), dtype='int16')
+        theirs = np.asarray(Image.open(octave_base + "_" + name + ".png"), dtype='int16')
+        if ours.shape != theirs.shape:
+            diffs[name] = (None, None)
+            continue
+        delta = np.abs(ours - theirs)
+        diffs[name] = (int(delta.max()), int(np.count_nonzero(delta)))
+    return diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute PSII fluorescence features without Octave")
+    parser.add_argument('path_dark', help="directory with the dark-adapted capture")
+    parser.add_argument('path_light', help="directory with the light-adapted capture")
+    parser.add_argument('out_base', help="output path prefix, as passed to PSII.m")
+    parser.add_argument('--width', type=int, default=1936)
+    parser.add_argument('--height', type=int, default=1216)
+    parser.add_argument('--fmax-window', type=int, default=None,
+                        help="stop reading frames this many frames after the Fm candidates settle")
+    parser.add_argument('--compare', help="output prefix of a PSII.m run to compare against")
+    args = parser.parse_args()
+
+    paths, fm_dark_frame, fm_light_frame = psii_features(args.path_dark, args.path_light, args.out_base,
+                                                         args.width, args.height, args.fmax_window)
+    print("Fm_dark frame %s, Fm_light frame %s; wrote %s images" % (fm_dark_frame, fm_light_frame, len(paths)))
+
+    if args.compare:
+        for name, (max_diff, count) in compare_outputs(args.out_base, args.compare).items():
+            if max_diff is None:
+                print("%-12s shape differs" % name)
+            else:
+                print("%-12s max difference %3s, %s pixels differ" % (name, max_diff, count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+function psii_server()
+
+% Long-lived Octave worker for octave_worker.py
+%
+% Runs PSII once on a tiny synthetic capture, so PSII.m is parsed and the image
+% package loaded before the first real capture, then evaluates one command per
+% line read from stdin. After each command it prints a single status line:
+%   __DONE__ ok <seconds>
+%   __DONE__ error <message>
+% Other output (e.g. warnings) may appear before the status line.
+
+warmup_dir = tempname();
+mkdir(warmup_dir);
+for i = 0:101
+  fid = fopen(fullfile(warmup_dir, sprintf('warmup_%04d.bin', i)), 'w');
+  fwrite(fid, mod(i, 50) * ones(4, 3), 'uint8');
+  fclose(fid);
+end
+try
+  PSII(warmup_dir, warmup_dir, fullfile(warmup_dir, 'warmup'), 4, 3);
+catch err
+  printf('warm-up failed: %s\n', err.message);
+end
+confirm_recursive_rmdir(false);
+rmdir(warmup_dir, 's');
+
+printf('__READY__\n');
+fflush(stdout);
+
+while true
+  line = fgetl(stdin);
+  if ~ischar(line)
+    break;
+  end
+  t0 = tic;
+  try
+    eval(line);
+    printf('__DONE__ ok %f\n', toc(t0));
+  catch err
+    printf('__DONE__ error %s\n', strrep(err.message, sprintf('\n'), ' '));
+  end
+  fflush(stdout);
+end
+
+end
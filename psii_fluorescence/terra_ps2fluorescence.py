@@ -2,69 +2,113 @@
 
 import os
 import logging
-import subprocess
 
 from pyclowder.utils import CheckMessage
 from pyclowder.datasets import upload_metadata
 from pyclowder.files import upload_to_dataset
-from terrautils.extractors import TerrarefExtractor, is_latest_file, build_metadata, build_dataset_hierarchy
-
+from terrautils.extractors import TerrarefExtractor, is_latest_file, build_metadata, load_json_file
+from terrautils.metadata import get_terraref_metadata
+
+from hierarchy_cache import resolve_dataset, invalidate_on_404
+from psii_frames import get_image_dimensions
+from capture_tracker import CAPTURE_FILES, get_tracker, index_frames, is_complete
+from psii_features import psii_features
+from octave_worker import OctavePool
+
+
+def add_local_arguments(parser):
+    # add any additional arguments to parser
+    parser.add_argument('--engine', dest="engine", choices=['python', 'octave'], default='octave',
+                        help="compute features with PSII.m in persistent Octave workers, or in-process with NumPy")
+    parser.add_argument('--octave-workers', dest="octave_workers", type=int, default=1,
+                        help="Octave processes kept running for the octave engine")
+    parser.add_argument('--octave-timeout', dest="octave_timeout", type=int, default=600,
+                        help="seconds a PSII.m call may take before its Octave worker is restarted")
+    parser.add_argument('--fmax-window', dest="fmax_window", type=int, default=None,
+                        help="python engine: stop reading frames this many frames after the Fm peak (default: read all)")
 
 class PSIIFluorescenceFeatures(TerrarefExtractor):
     def __init__(self):
         super(PSIIFluorescenceFeatures, self).__init__()
 
+        add_local_arguments(self.parser)
+
         # parse command line and load default logging configuration
         self.setup(sensor="ps2_fluorescence")
 
+        self.engine = self.args.engine
+        self.octave_timeout = self.args.octave_timeout
+        self.fmax_window = self.args.fmax_window
+        # started now, then kept warm across captures
+        self.octave_pool = OctavePool(self.args.octave_workers) if self.engine == 'octave' else None
+
     def check_message(self, connector, host, secret_key, resource, parameters):
+        # Every file.added event of a capture lands here; only the one that completes it needs real work
+        tracker = get_tracker(self.extractor_info['name'])
+        if tracker.claimed(resource['id']) and not self.overwrite:
+            return CheckMessage.ignore
+
         # Check for 0000-0101 bin files before beginning processing
-        if len(resource['files']) < 102:
+        if len(resource['files']) < CAPTURE_FILES:
+            return CheckMessage.ignore
+        # Do we have too few input BIN files?
+        if not is_complete(index_frames(resource['files'])):
             return CheckMessage.ignore
         if not is_latest_file(resource):
             return CheckMessage.ignore
 
-        # Count number of bin files in dataset, as well as number of existing outputs
-        ind_add = 0
-        for ind in range(0, 102):
-            format_ind = "{0:0>4}".format(ind) # e.g. 1 becomes 0001
-            for f in resource['files']:
-                if f['filename'].endswith(format_ind+'.bin'):
-                    ind_add += 1
-                    break
-		    
-        # Do we have too few input BIN files?
-        if ind_add < 102:
-            return CheckMessage.ignore
-        else:
-            return CheckMessage.download
+        tracker.claim(resource['id'])
+        return CheckMessage.download
 
     def process_message(self, connector, host, secret_key, resource, parameters):
+        tracker = get_tracker(self.extractor_info['name'])
+        processed = False
+        try:
+            processed = self.process_capture(connector, host, secret_key, resource, parameters)
+        finally:
+            if processed:
+                tracker.complete(resource['id'])
+            else:
+                # the claim made in check_message would hide retries and resubmissions until it expires
+                tracker.release(resource['id'])
+
+    def process_capture(self, connector, host, secret_key, resource, parameters):
         self.start_message()
 
+        metadata = None
         for p in resource['local_paths']:
             if p.endswith(".bin"):
                 input_dir = p.replace(os.path.basename(p), '')
                 # TODO: Eventually light may be in separate location
                 input_dir_light = input_dir
+            elif p.endswith('_dataset_metadata.json'):
+                metadata = get_terraref_metadata(load_json_file(p), "ps2Top")
 
         # Determine output directory
         timestamp = resource['dataset_info']['name'].split(" - ")[1]
         out_name_base = self.sensors.create_sensor_path(timestamp, ext='')
         uploaded_file_ids = []
 
-        subprocess.call(["octave --eval \"PSII(\'%s\',\'%s\' ,\'%s\')\"" %
-                         (input_dir, input_dir_light, out_name_base)],shell=True);
+        if self.engine == 'python':
+            (img_width, img_height) = get_image_dimensions(metadata or {})
+            _, fm_dark_frame, fm_light_frame = psii_features(input_dir, input_dir_light, out_name_base,
+                                                             int(img_width), int(img_height), self.fmax_window)
+            logging.info("Fm_dark from frame %s, Fm_light from frame %s" % (fm_dark_frame, fm_light_frame))
+        else:
+            elapsed, octave_elapsed = self.octave_pool.psii(input_dir, input_dir_light, out_name_base,
+                                                            timeout=self.octave_timeout)
+            logging.info("PSII.m finished in %.1fs (%.1fs in Octave)" % (elapsed, octave_elapsed))
 
-        target_dsid = build_dataset_hierarchy(connector, host, secret_key, self.clowderspace,
-                                              self.sensors.get_display_name(), timestamp[:4], timestamp[:7],
-                                              timestamp[:10], leaf_ds_name=resource['dataset_info']['name'])
+        target_dsid = resolve_dataset(host, secret_key, self.clowder_user, self.clowder_pass, self.clowderspace,
+                                      None, None, self.sensors.get_display_name(), timestamp[:10],
+                                      resource['dataset_info']['name'])
 
         for out_file in ["_Fm_dark", "_Fv_dark", "_FvFm_dark", "_Fm_light", "_Fv_light", "_FvFm_light",
                          "_Phi_PSII", "_NPQ", "_qN", "_qP", "_Rfd"]:
             full_out_name = out_name_base + out_file + ".png"
             if os.path.isfile(full_out_name) and full_out_name not in resource["local_paths"]:
-                fileid = upload_to_dataset(connector, host, secret_key, target_dsid, full_out_name)
+                with invalidate_on_404(target_dsid):
+                    fileid = upload_to_dataset(connector, host, secret_key, target_dsid, full_out_name)
                 uploaded_file_ids.append(fileid)
             self.created += 1
             self.bytes += os.path.getsize(full_out_name)
@@ -75,6 +119,7 @@ class PSIIFluorescenceFeatures(TerrarefExtractor):
         upload_metadata(connector, host, secret_key, resource['id'], metadata)
 
         self.end_message()
+        return True
 
 if __name__ == "__main__":
     extractor = PSIIFluorescenceFeatures()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+Measure extractor cold-start time: from process launch until extractor.start() is called.
+
+Each extractor script is run in a fresh interpreter with pyclowder's Extractor.start
+replaced by a stub that reports the elapsed time and exits, so no RabbitMQ
+connection is made. Run from the repository root inside an environment that has
+the extractor dependencies (e.g. the terrautils image):
+
+    python startup_benchmark.py -n 5
+    python startup_benchmark.py flir2tif psii2png
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+EXTRACTORS = [
+    ('flir2tif', 'terra_flir2tif.py'),
+    ('meantemp', 'terra_meantemp.py'),
+    ('psii2png', 'terra_psii2png.py'),
+    ('psii_fluorescence', 'terra_ps2fluorescence.py'),
+    ('ndvipri2csv', 'terra_ndvipri2csv.py'),
+]
+
+# Executed by the child interpreter; argv is [launch timestamp, script name]
+CHILD_CODE = """
+import os, sys, time, runpy
+launched = float(sys.argv[1])
+script = sys.argv[2]
+sys.argv = [script]
+sys.path.insert(0, os.getcwd())
+
+from pyclowder.extractors import Extractor
+def report_start(self):
+    sys.stdout.write('STARTUP %f\\n' % (time.time() - launched))
+    sys.stdout.flush()
+    os._exit(0)
+Extractor.start = report_start
+
+runpy.run_path(script, run_name='__main__')
+"""
+
+
+def options():
+    parser = argparse.ArgumentParser(description='Measure time from process launch to extractor.start()',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('extractors', nargs='*', help="extractor directories to measure (default: all)")
+    parser.add_argument('-n', '--runs', type=int, default=3, help="cold starts per extractor")
+    parser.add_argument('--python', default=sys.executable, help="interpreter used to launch extractors")
+    return parser.parse_args()
+
+
+def measure(python, ext_dir, script):
+    launched = time.time()
+    proc = subprocess.Popen([python, '-c', CHILD_CODE, repr(launched), script], cwd=ext_dir,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    for line in out.decode('utf-8', 'replace').splitlines():
+        if line.startswith('STARTUP '):
+            return float(line.split()[1]), None
+    return None, err.decode('utf-8', 'replace').strip().splitlines()[-1:] or ['exit code %s' % proc.returncode]
+
+
+def main():
+    args = options()
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+
+    selected = [e for e in EXTRACTORS if not args.extractors or e[0] in args.extractors]
+    print("%-20s %10s %10s %10s" % ('extractor', 'min (s)', 'median (s)', 'max (s)'))
+    for ext_name, script in selected:
+        timings, error = [], None
+        for i in range(args.runs):
+            elapsed, error = measure(args.python, os.path.join(base_dir, ext_name), script)
+            if elapsed is None:
+                break
+            timings.append(elapsed)
+
+        if error is not None:
+            print("%-20s failed: %s" % (ext_name, error[0]))
+            continue
+        timings.sort()
+        print("%-20s %10.3f %10.3f %10.3f" % (ext_name, timings[0], timings[len(timings)//2], timings[-1]))
+
+
+if __name__ == "__main__":
+    main()
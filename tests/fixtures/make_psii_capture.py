@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+'''
+Generate the small synthetic PSII capture in psii_capture/
+
+32 x 24 frames laid out like a camera capture: a background strip on the left,
+plants elsewhere with a per-pixel Fv/Fm between 0.5 and 0.8, a base frame 0001
+without the red flash, F0 in frame 0002 and a saturating pulse peaking at frame
+0024. Frame 0101 stands in for the frame-time list.
+
+The capture is checked in; this script only documents how it was made.
+'''
+
+import os
+import numpy as np
+
+WIDTH = 32
+HEIGHT = 24
+FRAMES = 101
+OUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'psii_capture')
+
+
+def make_frames(seed=0):
+    rng = np.random.RandomState(seed)
+    leaf = np.ones((HEIGHT, WIDTH))
+    leaf[:, :8] = 0
+    fvfm = rng.uniform(0.5, 0.8, (HEIGHT, WIDTH))
+    base = 20 + rng.randint(0, 4, (HEIGHT, WIDTH))
+    f0 = 40 * leaf
+    fm = f0 / (1 - fvfm)
+
+    frames = []
+    for ind in range(FRAMES):
+        if ind == 0:
+            level = np.full((HEIGHT, WIDTH), 3.0)
+        elif ind == 1:
+            level = base
+        else:
+            # rises from F0 to Fm by frame 24, then relaxes towards the middle
+            pulse = np.exp(-((ind - 24) / 10.0) ** 2) if ind < 24 else 0.6 + 0.4 * np.exp(-(ind - 24) / 15.0)
+            level = base + f0 + (fm - f0) * pulse
+        noise = rng.randint(0, 3, (HEIGHT, WIDTH))
+        frames.append(np.clip(np.round(level) + noise, 0, 255).astype('uint8'))
+    return frames
+
+
+def main():
+    if not os.path.isdir(OUT_DIR):
+        os.makedirs(OUT_DIR)
+    for ind, pixels in enumerate(make_frames()):
+        pixels.tofile(os.path.join(OUT_DIR, 'fixture_%04d.bin' % ind))
+    with open(os.path.join(OUT_DIR, 'fixture_0101.bin'), 'w') as f:
+        f.write('\n'.join('%.3f' % (0.01 * i) for i in range(FRAMES)) + '\n')
+
+
+if __name__ == '__main__':
+    main()
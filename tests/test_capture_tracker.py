@@ -0,0 +1,62 @@
+'''
+Claims of the PSII capture tracker (capture_tracker.CaptureTracker)
+'''
+
+import os
+import sys
+import json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'psii2png'))
+
+from capture_tracker import CaptureTracker
+
+
+def test_claim_in_flight_is_not_persisted(tmpdir):
+    state_file = str(tmpdir.join('captures.json'))
+    tracker = CaptureTracker(state_file=state_file, namespace='terra.multispectral.psii2png')
+    tracker.claim('ds1')
+    assert tracker.claimed('ds1')
+
+    # the extractor crashed before finishing: a restarted one processes the redelivered message
+    assert not os.path.exists(state_file)
+    assert not CaptureTracker(state_file=state_file, namespace='terra.multispectral.psii2png').claimed('ds1')
+
+    tracker.complete('ds1')
+    assert CaptureTracker(state_file=state_file, namespace='terra.multispectral.psii2png').claimed('ds1')
+
+
+def test_release_drops_the_claim(tmpdir):
+    state_file = str(tmpdir.join('captures.json'))
+    tracker = CaptureTracker(state_file=state_file, namespace='terra.multispectral.psii2png')
+    tracker.claim('ds1')
+    tracker.release('ds1')
+    assert not tracker.claimed('ds1')
+
+    tracker.complete('ds2')
+    tracker.release('ds2')
+    assert not CaptureTracker(state_file=state_file, namespace='terra.multispectral.psii2png').claimed('ds2')
+
+
+def test_extractors_share_a_state_file(tmpdir):
+    state_file = str(tmpdir.join('captures.json'))
+    png = CaptureTracker(state_file=state_file, namespace='terra.multispectral.psii2png')
+    fluorescence = CaptureTracker(state_file=state_file, namespace='terra.multispectral.ps2fluorescence')
+
+    png.complete('ds1')
+    assert not fluorescence.claimed('ds1')
+    fluorescence.complete('ds2')
+
+    with open(state_file) as f:
+        assert sorted(json.load(f)) == ['terra.multispectral.ps2fluorescence:ds2',
+                                        'terra.multispectral.psii2png:ds1']
+    assert CaptureTracker(state_file=state_file, namespace='terra.multispectral.psii2png').claimed('ds1')
+    assert not CaptureTracker(state_file=state_file, namespace='terra.multispectral.psii2png').claimed('ds2')
+
+
+def test_claims_expire(tmpdir):
+    tracker = CaptureTracker(ttl=-1)
+    tracker.claim('ds1')
+    assert not tracker.claimed('ds1')
+    tracker.complete('ds2')
+    assert not tracker.claimed('ds2')
@@ -0,0 +1,92 @@
+'''
+Early termination of the streaming F-max scan (psii_frames.FmaxScanner)
+'''
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'psii_fluorescence'))
+
+from psii_frames import FrameStats
+from psii_features import find_frames, read_adapted_frames
+import psii_features
+
+CAPTURE = os.path.join(ROOT, 'tests', 'fixtures', 'psii_capture')
+
+
+def scan(levels, window):
+    """Stream uniform frames with the given levels through FrameStats as terra_psii2png does."""
+    stats = FrameStats(nframes=len(levels), fmax_window=window)
+    for ind, level in enumerate(levels):
+        if stats.finished():
+            break
+        stats.add(ind, np.full((4, 3), level, dtype='uint8'))
+    return stats
+
+
+FLAT_BEFORE_PULSE = [50] * 30 + [60, 80, 120, 200, 180, 150] + [120] * 65
+FALLING_BEFORE_PULSE = [90 - i for i in range(30)] + [80, 150, 220, 200] + [150] * 67
+
+
+@pytest.mark.parametrize('levels, peak', [(FLAT_BEFORE_PULSE, 33), (FALLING_BEFORE_PULSE, 32)])
+def test_window_waits_for_the_pulse(levels, peak):
+    full = scan(levels, None)
+    early = scan(levels, 5)
+    assert full.fmax_index == early.fmax_index == peak
+    assert early.seen.sum() < len(levels)
+    assert early.seen[:peak + 6].all()
+
+
+def test_no_pulse_reads_every_frame():
+    stats = scan([50] * 101, 5)
+    assert stats.seen.all()
+    assert stats.fmax_index == 0
+
+
+def test_features_scan_stops_after_the_pulse(monkeypatch):
+    frames = find_frames(CAPTURE)
+    full = read_adapted_frames(frames, 32, 24)
+
+    read = []
+    read_frame = psii_features.read_frame
+    monkeypatch.setattr(psii_features, 'read_frame', lambda path, w, h: read.append(path) or read_frame(path, w, h))
+    early = read_adapted_frames(frames, 32, 24, fmax_window=5)
+
+    assert early[3] == full[3] == 23
+    for ours, theirs in zip(early[:3], full[:3]):
+        assert np.array_equal(ours, theirs)
+    assert len(read) < len(frames)
+
+
+def test_saturated_pixels_in_fmin_do_not_disable_the_window():
+    # a handful of saturated pixels in Fmin put 1.5x its maximum above 255
+    rng = np.random.RandomState(1)
+    leaf = np.zeros((24, 32), dtype=bool)
+    leaf[:, 8:] = True
+    pulse = [0.0, 0.0] + [np.exp(-((ind - 30) / 8.0) ** 2) if ind < 30 else 0.5 for ind in range(2, 101)]
+
+    frames = []
+    for ind, p in enumerate(pulse):
+        level = (3 if ind == 0 else 20) + leaf * (30 + 180 * p) + rng.randint(0, 3, leaf.shape)
+        frames.append(np.clip(level, 0, 255).astype('uint8'))
+    frames[1][5, 20:24] = 255
+
+    def scan_frames(window):
+        stats = FrameStats(fmax_window=window)
+        for ind, pixels in enumerate(frames):
+            if stats.finished():
+                break
+            stats.add(ind, pixels)
+        return stats
+
+    full = scan_frames(None)
+    early = scan_frames(5)
+    assert full.max[1] == 255 and full.max[2:].max() < 255
+    assert full.fmax_index == early.fmax_index
+    assert abs(full.fmax_index - 30) <= 1
+    assert early.scanner.armed
+    assert early.seen.sum() < len(frames)
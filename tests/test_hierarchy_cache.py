@@ -0,0 +1,96 @@
+'''
+Caching of the Clowder collection hierarchy (hierarchy_cache.resolve_dataset)
+'''
+
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'psii2png'))
+
+import hierarchy_cache
+
+
+class FakeClowder(object):
+    """Records the terrautils collection and dataset calls and hands out ids."""
+
+    def __init__(self):
+        self.collection_calls = []
+        self.dataset_calls = []
+
+    def get_collection_or_create(self, host, secret_key, user, password, name, parent_colln=None, parent_space=None):
+        self.collection_calls.append(name)
+        return 'c:' + name
+
+    def ensure_collection_in_children(self, host, secret_key, user, password, space, parent, name):
+        self.collection_calls.append(name)
+        return 'c:' + name
+
+    def get_dataset_or_create(self, host, secret_key, user, password, name, parent_colln=None, parent_space=None):
+        self.dataset_calls.append((name, parent_colln))
+        return 'd:' + name
+
+
+@pytest.fixture
+def clowder(monkeypatch):
+    fake = FakeClowder()
+    module = types.ModuleType('terrautils.extractors')
+    for name in ('get_collection_or_create', 'ensure_collection_in_children', 'get_dataset_or_create'):
+        setattr(module, name, getattr(fake, name))
+    monkeypatch.setitem(sys.modules, 'terrautils', types.ModuleType('terrautils'))
+    monkeypatch.setitem(sys.modules, 'terrautils.extractors', module)
+    monkeypatch.setattr(hierarchy_cache, '_cache', hierarchy_cache.HierarchyCache(ttl=3600))
+    return fake
+
+
+def resolve(timestamp, season='Season 6', experiment='Sorghum'):
+    return hierarchy_cache.resolve_dataset('https://clowder/', 'key', 'user', 'pass', 'space',
+                                           season, experiment, 'Thermal', timestamp[:10], 'Thermal - ' + timestamp)
+
+
+def test_same_day_resolves_collections_once(clowder):
+    first = resolve('2018-05-01__10-00-00-000')
+    second = resolve('2018-05-01__10-00-05-000')
+
+    assert clowder.collection_calls == ['Season 6', 'Sorghum', 'Thermal', 'Thermal - 2018',
+                                        'Thermal - 2018-05', 'Thermal - 2018-05-01']
+    assert clowder.dataset_calls == [('Thermal - 2018-05-01__10-00-00-000', 'c:Thermal - 2018-05-01'),
+                                     ('Thermal - 2018-05-01__10-00-05-000', 'c:Thermal - 2018-05-01')]
+    assert (first, second) == ('d:Thermal - 2018-05-01__10-00-00-000', 'd:Thermal - 2018-05-01__10-00-05-000')
+
+
+def test_new_day_resolves_its_collections(clowder):
+    resolve('2018-05-01__10-00-00-000')
+    del clowder.collection_calls[:]
+    resolve('2018-05-02__10-00-00-000')
+    assert clowder.collection_calls == ['Season 6', 'Sorghum', 'Thermal', 'Thermal - 2018',
+                                        'Thermal - 2018-05', 'Thermal - 2018-05-02']
+
+
+def test_sensor_without_season(clowder):
+    resolve('2018-05-01__10-00-00-000', season=None, experiment=None)
+    assert clowder.collection_calls == ['Thermal', 'Thermal - 2018', 'Thermal - 2018-05', 'Thermal - 2018-05-01']
+
+
+def test_404_on_leaf_drops_the_day(clowder):
+    class Response(object):
+        status_code = 404
+
+    class NotFound(Exception):
+        response = Response()
+
+    resolve('2018-05-01__10-00-00-000')
+
+    def missing(*args, **kwargs):
+        raise NotFound()
+    sys.modules['terrautils.extractors'].get_dataset_or_create = missing
+    with pytest.raises(NotFound):
+        resolve('2018-05-01__10-00-05-000')
+
+    sys.modules['terrautils.extractors'].get_dataset_or_create = clowder.get_dataset_or_create
+    del clowder.collection_calls[:]
+    resolve('2018-05-01__10-00-10-000')
+    assert clowder.collection_calls[-1] == 'Thermal - 2018-05-01'
@@ -0,0 +1,200 @@
+'''
+meantemp zonal statistics and incremental reruns, against a stub GDAL
+
+The stub serves .npy files as single-band rasters with 16 x 8 pixel blocks and
+a geotransform of one unit per pixel, so plot bounds are pixel coordinates
+(lat = -row, long = column).
+'''
+
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'meantemp'))
+
+from zonal_stats import StatsKernel, plot_stats
+from plot_index import PlotIndex
+from plot_state import load_plot_state, known_checksums, restore_unchanged, save_plot_state
+from result_table import ResultTable
+
+GEOTRANSFORM = (0.0, 1.0, 0.0, 0.0, 0.0, -1.0)
+
+
+class FakeBand(object):
+    def __init__(self, values):
+        self.values = values
+        self.YSize, self.XSize = values.shape
+
+    def GetBlockSize(self):
+        return 16, 8
+
+    def ReadAsArray(self, xoff=0, yoff=0, win_xsize=None, win_ysize=None):
+        win_xsize = self.XSize if win_xsize is None else win_xsize
+        win_ysize = self.YSize if win_ysize is None else win_ysize
+        return self.values[yoff:yoff+win_ysize, xoff:xoff+win_xsize].copy()
+
+
+class FakeDataset(object):
+    def __init__(self, path):
+        self.band = FakeBand(np.load(path))
+        self.RasterYSize, self.RasterXSize = self.band.values.shape
+
+    def GetGeoTransform(self):
+        return GEOTRANSFORM
+
+    def GetRasterBand(self, n):
+        return self.band
+
+
+@pytest.fixture(autouse=True)
+def fake_gdal(monkeypatch):
+    # forked pool workers inherit these modules too
+    gdal = types.ModuleType('osgeo.gdal')
+    gdal.GA_ReadOnly = 0
+    gdal.SetConfigOption = lambda key, value: None
+    gdal.SetCacheMax = lambda size: None
+    gdal.Open = lambda path, mode=0: FakeDataset(path)
+    osgeo = types.ModuleType('osgeo')
+    osgeo.gdal = gdal
+    monkeypatch.setitem(sys.modules, 'osgeo', osgeo)
+    monkeypatch.setitem(sys.modules, 'osgeo.gdal', gdal)
+
+
+def plot_bounds(row, col, rows=20, cols=20):
+    """(lat min, lat max, long min, long max) of a plot covering rows x cols pixels from (row, col)."""
+    return (-(row + rows), -row, col, col + cols)
+
+
+def make_plots(shift_plot=None):
+    names, bounds = [], []
+    for row in (0, 20):
+        for col in (0, 20, 40):
+            names.append('plot_%s_%s' % (row, col))
+            bounds.append(plot_bounds(row, col + (2 if names[-1] == shift_plot else 0)))
+    # partly off the raster, and fully off it
+    names += ['plot_edge', 'plot_outside']
+    bounds += [plot_bounds(30, 50), plot_bounds(100, 100)]
+    return PlotIndex(names, bounds, [(b[2], b[0]) for b in bounds])
+
+
+def make_raster(tmpdir, seed=0, name='mosaic.npy'):
+    rng = np.random.RandomState(seed)
+    values = rng.uniform(290.0, 310.0, (40, 60)).astype('float32')
+    values[3, 5] = np.nan
+    values[25:30, 22:27] = -9999.0
+    values[20:40, 40:60][rng.uniform(size=(20, 20)) < 0.1] = -1
+    path = str(tmpdir.join(name))
+    np.save(path, values)
+    return path, values
+
+
+def assert_stats_equal(a, b):
+    assert list(a) == list(b)
+    for name in a:
+        np.testing.assert_array_equal(a[name], b[name], err_msg=name)
+
+
+KERNEL = StatsKernel(percentiles=[5, 50, 95])
+
+
+def test_read_paths_agree(tmpdir):
+    path, values = make_raster(tmpdir)
+    plots = make_plots()
+
+    expected_plots, expected = plot_stats(path, plots, KERNEL, windowed=True)
+    assert list(plots.names[expected_plots]) == ['plot_0_0', 'plot_0_20', 'plot_0_40', 'plot_20_0',
+                                                 'plot_20_20', 'plot_20_40', 'plot_edge']
+    for kwargs in ({'windowed': True, 'sort_rows': False},
+                   {'windowed': False},
+                   {'windowed': True, 'workers': 3}):
+        result_plots, result = plot_stats(path, plots, KERNEL, **kwargs)
+        np.testing.assert_array_equal(result_plots, expected_plots)
+        assert_stats_equal(result, expected)
+
+
+def test_stats_match_numpy(tmpdir):
+    path, values = make_raster(tmpdir)
+    plots = make_plots()
+    result_plots, stats = plot_stats(path, plots, KERNEL)
+
+    for i, p in enumerate(result_plots):
+        min_y, max_y, min_x, max_x = plots.bounds[p]
+        window = values[int(-max_y):int(-min_y), int(min_x):int(max_x)]
+        with np.errstate(invalid='ignore'):
+            valid = window[window >= 0].astype('float64')
+
+        assert stats['pixel_count'][i] == window.size
+        assert stats['valid_count'][i] == valid.size
+        assert stats['mean'][i] == pytest.approx(valid.mean())
+        assert stats['variance'][i] == pytest.approx(valid.var(), rel=1e-6)
+        assert (stats['min'][i], stats['max'][i]) == (valid.min(), valid.max())
+        for q in KERNEL.percentiles:
+            # the histogram finds the bin holding the inverted-CDF order statistic
+            expected = np.nanpercentile(valid, q, method='inverted_cdf')
+            assert abs(stats['p%g' % q][i] - expected) <= KERNEL.bin_width
+
+
+def incremental_run(path, plots, state_file, workers=1):
+    """What terra_meantemp does with --incremental, minus Clowder."""
+    previous = load_plot_state(state_file, KERNEL.names())
+    known = known_checksums(previous, plots.names, plots.bounds.tolist())
+    result_plots, stats = plot_stats(path, plots, KERNEL, workers=workers, known=known)
+    names = plots.names[result_plots]
+    changed = restore_unchanged(previous, names, stats)
+    save_plot_state(state_file, KERNEL.names(), names, plots.bounds[result_plots].tolist(), stats['checksum'], stats)
+    return names, stats, changed
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_rerun_recomputes_only_the_modified_plot(tmpdir, workers):
+    path, values = make_raster(tmpdir)
+    plots = make_plots()
+    state_file = str(tmpdir.join('state.json'))
+
+    names, first, changed = incremental_run(path, plots, state_file, workers)
+    assert changed.all()
+
+    values[22, 45] += 5.0
+    np.save(path, values)
+    names, rerun, changed = incremental_run(path, plots, state_file, workers)
+    assert list(names[changed]) == ['plot_20_40']
+
+    # unchanged plots are restored from the state, the changed one recomputed
+    result_plots, fresh = plot_stats(path, plots, KERNEL)
+    for name in KERNEL.names():
+        np.testing.assert_array_equal(rerun[name], fresh[name], err_msg=name)
+    assert rerun['mean'][changed][0] != first['mean'][changed][0]
+
+    # the _changed.csv rows are the valid, changed plots
+    table = ResultTable([('site', names), ('surface_temperature', rerun['mean'] - 273.15)])
+    valid = ~np.isnan(table['surface_temperature'])
+    out_csv = str(tmpdir.join('meantemp_bety_changed.csv'))
+    table.select(valid & changed).write_csv(out_csv, ['site', 'surface_temperature'])
+    with open(out_csv) as f:
+        rows = f.read().splitlines()
+    assert rows[0] == 'site,surface_temperature'
+    assert [r.split(',')[0] for r in rows[1:]] == ['plot_20_40']
+
+
+def test_moved_boundary_is_recomputed(tmpdir):
+    path, values = make_raster(tmpdir)
+    state_file = str(tmpdir.join('state.json'))
+    incremental_run(path, make_plots(), state_file)
+
+    names, stats, changed = incremental_run(path, make_plots(shift_plot='plot_0_20'), state_file)
+    assert list(names[changed]) == ['plot_0_20']
+    assert stats['pixel_count'][list(names).index('plot_0_20')] == 400
+
+
+def test_state_for_other_stats_is_dropped(tmpdir):
+    path, values = make_raster(tmpdir)
+    state_file = str(tmpdir.join('state.json'))
+    incremental_run(path, make_plots(), state_file)
+
+    assert load_plot_state(state_file, KERNEL.names()) is not None
+    assert load_plot_state(state_file, StatsKernel(percentiles=[50]).names()) is None
+    assert known_checksums(None, ['plot_0_0'], [plot_bounds(0, 0)]) == {}
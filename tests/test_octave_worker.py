@@ -0,0 +1,145 @@
+'''
+OctaveWorker and OctavePool against a fake octave executable
+
+The fake speaks psii_server.m's protocol: it prints __READY__ once started, then
+answers each command line from stdin with a __DONE__ status line. Commands:
+    ok       -- a warning line, then __DONE__ ok 0.25
+    fail     -- __DONE__ error <message>
+    sleep N  -- sleeps N seconds, then __DONE__ ok N
+    crash    -- exits with code 3
+Every command is also appended to commands.log in the working directory.
+FAKE_OCTAVE_STARTUP=hang makes it never print __READY__.
+'''
+
+import os
+import sys
+import stat
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'psii_fluorescence'))
+
+from octave_worker import OctaveWorker, OctavePool, OctaveError, OctaveTimeout
+
+FAKE_OCTAVE = '''#!%s
+import os
+import sys
+import time
+
+if os.environ.get('FAKE_OCTAVE_STARTUP') == 'hang':
+    time.sleep(60)
+print('loading the image package')
+print('__READY__')
+sys.stdout.flush()
+
+for line in iter(sys.stdin.readline, ''):
+    command = line.strip()
+    with open('commands.log', 'a') as log:
+        log.write(command + '\\n')
+    if command == 'crash':
+        sys.exit(3)
+    elif command == 'fail':
+        print('__DONE__ error PSII: no frames found')
+    elif command.startswith('sleep '):
+        time.sleep(float(command.split()[1]))
+        print('__DONE__ ok %%s' %% command.split()[1])
+    else:
+        print('warning: something harmless')
+        print('__DONE__ ok 0.25')
+    sys.stdout.flush()
+''' % sys.executable
+
+
+@pytest.fixture
+def fake_octave(tmpdir):
+    path = str(tmpdir.join('octave'))
+    with open(path, 'w') as f:
+        f.write(FAKE_OCTAVE)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return {'octave': path, 'workdir': str(tmpdir), 'startup_timeout': 10}
+
+
+@pytest.fixture
+def worker(fake_octave):
+    worker = OctaveWorker(**fake_octave)
+    yield worker
+    worker.stop()
+
+
+def test_call_starts_the_worker_and_returns_timing(worker):
+    assert not worker.alive()
+    elapsed, octave_seconds = worker.call('ok')
+    assert worker.alive()
+    assert octave_seconds == 0.25
+    assert elapsed >= 0
+
+    pid = worker.proc.pid
+    worker.call('ok')
+    assert worker.proc.pid == pid
+
+
+def test_error_status_keeps_the_worker(worker):
+    worker.call('ok')
+    pid = worker.proc.pid
+    with pytest.raises(OctaveError) as ex:
+        worker.call('fail')
+    assert str(ex.value) == 'PSII: no frames found'
+    assert worker.alive() and worker.proc.pid == pid
+    assert worker.call('ok')[1] == 0.25
+
+
+def test_timeout_kills_the_worker(worker):
+    worker.call('ok')
+    proc = worker.proc
+    with pytest.raises(OctaveTimeout):
+        worker.call('sleep 30', timeout=0.5)
+    assert not worker.alive()
+    assert proc.poll() is not None
+
+    assert worker.call('ok')[1] == 0.25
+    assert worker.proc.pid != proc.pid
+
+
+def test_crashed_worker_is_restarted(worker):
+    worker.call('ok')
+    pid = worker.proc.pid
+    with pytest.raises(OctaveError) as ex:
+        worker.call('crash')
+    assert not isinstance(ex.value, OctaveTimeout)
+    assert 'code 3' in str(ex.value)
+    assert not worker.alive()
+
+    assert worker.call('ok')[1] == 0.25
+    assert worker.proc.pid != pid
+
+
+def test_startup_timeout(fake_octave, monkeypatch):
+    monkeypatch.setenv('FAKE_OCTAVE_STARTUP', 'hang')
+    fake_octave['startup_timeout'] = 0.5
+    worker = OctaveWorker(**fake_octave)
+    with pytest.raises(OctaveTimeout):
+        worker.start()
+    assert worker.proc is None
+
+
+def test_pool_starts_its_workers_up_front(fake_octave, tmpdir):
+    pool = OctavePool(2, **fake_octave)
+    try:
+        workers = list(pool.idle.queue)
+        assert len(workers) == 2
+        assert all(w.alive() for w in workers)
+
+        pool.psii("/data/it's dark/", "/data/light/", "/out/capture")
+        with open(str(tmpdir.join('commands.log'))) as f:
+            assert f.read().splitlines() == ["PSII('/data/it''s dark/', '/data/light/', '/out/capture')"]
+    finally:
+        pool.close()
+    assert not any(w.alive() for w in workers)
+
+
+def test_pool_without_octave_starts_lazily(tmpdir):
+    pool = OctavePool(1, octave=str(tmpdir.join('missing')), workdir=str(tmpdir))
+    assert not list(pool.idle.queue)[0].alive()
+    with pytest.raises(OSError):
+        pool.call('ok')
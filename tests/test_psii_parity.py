@@ -0,0 +1,177 @@
+'''
+Parity of psii_features.py (the python engine) with PSII.m (the octave engine)
+
+Both engines run on the synthetic capture in fixtures/psii_capture. PSII.m runs
+when octave (with the image package) is on the PATH. Otherwise the comparison
+is made against psii_m(), a statement-by-statement transcription of PSII.m in
+NumPy that keeps Octave's semantics where the python engine takes shortcuts:
+the dir() listing with '.' and '..', zero-filled M and FrameIndex, a stable
+sort for the Fm frame, column-major fread, int32 rounding of the 99th
+percentile rank and uint8 saturation in imwrite.
+'''
+
+import os
+import sys
+import math
+import subprocess
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENGINE_DIR = os.path.join(ROOT, 'psii_fluorescence')
+sys.path.insert(0, ENGINE_DIR)
+
+from psii_features import FEATURES, psii_features, find_frames, read_adapted_frames, compute_features, \
+    background_mask
+
+CAPTURE = os.path.join(ROOT, 'tests', 'fixtures', 'psii_capture') + os.sep
+WIDTH = 32
+HEIGHT = 24
+
+
+def load_png(out_base, name):
+    from PIL import Image
+    return np.asarray(Image.open(out_base + "_" + name + ".png"), dtype='int16')
+
+
+@pytest.fixture(scope='module')
+def python_outputs(tmpdir_factory):
+    out_base = str(tmpdir_factory.mktemp('python').join('capture'))
+    psii_features(CAPTURE, CAPTURE, out_base, WIDTH, HEIGHT)
+    return out_base
+
+
+def octave_dir(path):
+    """dir(path) as Octave lists it: '.', '..' and the entries sorted by name."""
+    return ['.', '..'] + sorted(os.listdir(path))
+
+
+def octave_fread(path, width, height):
+    """fread(fileID, [width, height], 'uint8') as doubles; the matrix is filled column by column."""
+    return np.fromfile(path, np.dtype('uint8')).astype('float64').reshape(height, width).T
+
+
+def octave_uint8(values):
+    """uint8(values * 255) as in imwrite: NaN is 0, halves round away from zero, out of range saturates."""
+    scaled = values * 255
+    scaled[np.isnan(scaled)] = 0
+    return np.clip(np.sign(scaled) * np.floor(np.abs(scaled) + 0.5), 0, 255).astype('uint8')
+
+
+def adapted_frames(path, width, height):
+    """PSII.m's frame loop and Fm / F0 selection for one capture: (Fm, F0) with F_base subtracted."""
+    D = octave_dir(path)
+    M = np.zeros(len(D) - 1)
+    FrameIndex = np.zeros(len(D) - 1, dtype=int)
+    for i in range(len(D) - 1):  # frame 101 is metadata
+        if 'bin' in D[i]:
+            A = octave_fread(os.path.join(path, D[i]), width, height) / 255
+            M[i] = np.mean(np.mean(A, axis=0))
+            FrameIndex[i] = int(D[i][-8:-4])
+
+    def read(i):
+        return octave_fread(os.path.join(path, D[i]), width, height) / 255
+
+    F_base = read(np.flatnonzero(FrameIndex == 1)[0])
+    SortID = np.argsort(M, kind='stable')
+    Fm = read(SortID[-2]) - F_base
+    F0 = read(np.flatnonzero(FrameIndex == 2)[0]) - F_base
+    return Fm, F0
+
+
+def fmask(Fm, width, height):
+    Fsort = np.sort(Fm.reshape(-1, order='F'))
+    rank = int(math.floor(width * height * 0.99 + 0.5))  # int32() rounds halves away from zero
+    return Fm > 0.1 * Fsort[rank - 1]
+
+
+def psii_m(path_dark, path_light, outputfilename, width, height):
+    """PSII(path_dark, path_light, outputfilename, width, height), written out in NumPy."""
+    from PIL import Image
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Fm_dark, F0_dark = adapted_frames(path_dark, width, height)
+        Fmask_dark = fmask(Fm_dark, width, height)
+        Fv_dark = (Fm_dark - F0_dark) * Fmask_dark
+        FvFm_dark = (Fv_dark / Fm_dark) * Fmask_dark
+        FvFm_dark[np.isnan(FvFm_dark)] = 0
+
+        Fm_light, F0_light_adapt = adapted_frames(path_light, width, height)
+        F0_light = F0_dark / ((Fv_dark / Fm_dark) + F0_dark / Fm_light)
+        Ft_light = F0_light - F0_dark
+        Fmask_light = fmask(Fm_light, width, height)
+        Fv_light = (Fm_light - F0_light_adapt) * Fmask_light
+        FvFm_light = (Fv_light / Fm_light) * Fmask_light
+        FvFm_light[np.isnan(FvFm_light)] = 0
+        FvFm_light[FvFm_light < 0] = 0
+
+        out = {
+            'Fm_dark': Fm_dark, 'Fv_dark': Fv_dark, 'FvFm_dark': FvFm_dark,
+            'Fm_light': Fm_light, 'Fv_light': Fv_light, 'FvFm_light': FvFm_light,
+            'Phi_PSII': (Fm_light - Ft_light) / Fm_light * Fmask_light,
+            'NPQ': (Fm_dark - Fm_light) / Fm_light * Fmask_light,
+            'qN': (Fm_dark - Fm_light) / (Fm_dark - F0_dark) * Fmask_light,
+            'qP': (Fm_light - Ft_light) / (Fm_dark - F0_dark) * Fmask_light,
+            'Rfd': (Fm_dark / Fm_light - 1) * Fmask_light,
+        }
+
+    for name, values in out.items():
+        Image.fromarray(octave_uint8(values)).save(outputfilename + '_' + name + '.png')
+
+
+@pytest.fixture(scope='module')
+def octave_outputs(tmpdir_factory):
+    out_base = str(tmpdir_factory.mktemp('octave').join('capture'))
+    if which('octave'):
+        command = "PSII('%s', '%s', '%s', %s, %s)" % (CAPTURE, CAPTURE, out_base, WIDTH, HEIGHT)
+        subprocess.check_call(['octave', '--quiet', '--no-gui', '--norc', '--eval', command], cwd=ENGINE_DIR)
+    else:
+        psii_m(CAPTURE, CAPTURE, out_base, WIDTH, HEIGHT)
+    return out_base
+
+
+@pytest.mark.skipif(not which('octave'), reason="octave is not installed")
+@pytest.mark.parametrize('name', FEATURES)
+def test_transcription_matches_psii_m(octave_outputs, tmpdir, name):
+    out_base = str(tmpdir.join('capture'))
+    psii_m(CAPTURE, CAPTURE, out_base, WIDTH, HEIGHT)
+    assert np.array_equal(load_png(out_base, name), load_png(octave_outputs, name))
+
+
+@pytest.mark.parametrize('name', FEATURES)
+def test_feature_matches_psii_m(python_outputs, octave_outputs, name):
+    ours = load_png(python_outputs, name)
+    theirs = load_png(octave_outputs, name)
+    assert ours.shape == theirs.shape == (WIDTH, HEIGHT)
+    # both engines compute in double precision; allow one grey level for rounding at .5
+    assert np.abs(ours - theirs).max() <= 1
+
+
+@pytest.mark.parametrize('name', ['FvFm_dark', 'FvFm_light'])
+def test_mask_matches_psii_m(python_outputs, octave_outputs, name):
+    # PSII.m does not write its background masks; they are the non-zero pixels of Fv/Fm
+    assert np.array_equal(load_png(python_outputs, name) > 0, load_png(octave_outputs, name) > 0)
+
+
+def test_fm_is_second_brightest_frame():
+    frames = find_frames(CAPTURE)
+    assert sorted(frames) == list(range(101))
+    f_base, fm, f0, fm_index = read_adapted_frames(frames, WIDTH, HEIGHT)
+    # the pulse peaks at frame 24; PSII.m takes the second highest mean to avoid an outlier
+    assert fm_index == 23
+
+
+def test_mask_excludes_background():
+    dark = read_adapted_frames(find_frames(CAPTURE), WIDTH, HEIGHT)
+    mask = background_mask(dark[1])
+    assert not mask[:, :8].any()
+    assert mask[:, 8:].all()
+
+    fvfm = compute_features(dark, dark)['FvFm_dark']
+    assert (fvfm[:, :8] == 0).all()
+    assert ((fvfm[:, 8:] > 0.4) & (fvfm[:, 8:] < 0.9)).all()
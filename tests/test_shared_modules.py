@@ -0,0 +1,27 @@
+'''
+Each extractor directory is its own Docker build context, so modules used by
+several extractors are copied into each of them. These copies must not drift.
+'''
+
+import os
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SHARED_MODULES = {
+    'hierarchy_cache.py': ['flir2tif', 'ndvipri2csv', 'psii2png', 'psii_fluorescence'],
+    'capture_tracker.py': ['psii2png', 'psii_fluorescence'],
+    'psii_frames.py': ['psii2png', 'psii_fluorescence'],
+}
+
+
+@pytest.mark.parametrize('module', sorted(SHARED_MODULES))
+def test_copies_are_identical(module):
+    copies = {}
+    for extractor in SHARED_MODULES[module]:
+        with open(os.path.join(ROOT, extractor, module), 'rb') as f:
+            copies[extractor] = f.read()
+
+    reference = SHARED_MODULES[module][0]
+    differing = [e for e in copies if copies[e] != copies[reference]]
+    assert not differing, "%s differs from %s/%s in: %s" % (module, reference, module, ", ".join(differing))